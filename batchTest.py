@@ -1,5 +1,6 @@
 import os
 import copy
+import time
 import pickle
 import argparse
 import numpy as np
@@ -19,6 +20,8 @@ except:
   print('[ENV WARNING] activate virtualenv to allow for testing MACE or MINT')
 import generateMOExplanations
 import generateFTExplanations
+import generateLeafExplanations
+import generateMILPExplanations
 try:
   import generateARExplanations
 except:
@@ -32,11 +35,29 @@ np.random.seed(RANDOM_SEED)
 
 
 def getEpsilonInString(approach_string):
+  # e.g., MACE_opt minimizes the distance directly, without an epsilon
+  if 'eps' not in approach_string:
+    return None
   tmp_index = approach_string.find('eps')
   epsilon_string = approach_string[tmp_index + 4 : tmp_index + 8]
   return float(epsilon_string)
 
 
+def getSATApproachString(approach_string):
+  # e.g., MACE_eps_1e-3 --> mace, MINT_opt --> mint_opt
+  sat_approach_string = 'mace' if 'MACE' in approach_string else 'mint'
+  if 'opt' in approach_string:
+    sat_approach_string = f'{sat_approach_string}_opt'
+  return sat_approach_string
+
+
+def getSATGenExp(norm_type_string):
+  # a list of norms is searched in one pass, returning explanations per norm
+  if isinstance(norm_type_string, list):
+    return generateSATExplanations.genExpForAllNorms
+  return generateSATExplanations.genExp
+
+
 def generateExplanations(
   approach_string,
   explanation_file_name,
@@ -47,32 +68,37 @@ def generateExplanations(
   observable_data_dict,
   standard_deviations,
   regression_min_diff,
-  outcome):
+  outcome,
+  sat_options = {},
+  warm_start_samples = None):
 
   if 'MACE' in approach_string: # 'MACE_counterfactual':
 
-    return generateSATExplanations.genExp(
+    return getSATGenExp(norm_type_string)(
       explanation_file_name,
       model_trained,
       dataset_obj,
       factual_sample,
       norm_type_string,
-      'mace',
+      getSATApproachString(approach_string),
       getEpsilonInString(approach_string),
       min_diff=regression_min_diff,
-      outcome=outcome
+      outcome=outcome,
+      warm_start_samples=warm_start_samples,
+      **sat_options
     )
 
   elif 'MINT' in approach_string: # 'MINT_counterfactual':
 
-    return generateSATExplanations.genExp(
+    return getSATGenExp(norm_type_string)(
       explanation_file_name,
       model_trained,
       dataset_obj,
       factual_sample,
       norm_type_string,
-      'mint',
-      getEpsilonInString(approach_string)
+      getSATApproachString(approach_string),
+      getEpsilonInString(approach_string),
+      **sat_options
     )
 
   elif approach_string == 'MO': # 'minimum_observable':
@@ -129,12 +155,46 @@ def generateExplanations(
       dataset_obj
     )
 
+  elif approach_string == 'MILP': # 'mixed_integer_linear_program':
+
+    return generateMILPExplanations.genExp(
+      explanation_file_name,
+      model_trained,
+      dataset_obj,
+      factual_sample,
+      norm_type_string,
+      outcome=outcome
+    )
+
+  elif approach_string == 'LEAF': # 'nearest_leaf_box':
+
+    return generateLeafExplanations.genExp(
+      explanation_file_name,
+      model_trained,
+      dataset_obj,
+      factual_sample,
+      norm_type_string,
+      outcome=outcome
+    )
+
   else:
 
     raise Exception(f'{approach_string} not recognized as a valid `approach_string`.')
 
 
-def runExperiments(dataset_values, model_class_values, norm_values, approaches_values, batch_number, sample_count, gen_cf_for, process_id, regression_min_diff, outcome):
+def runExperiments(dataset_values, model_class_values, norm_values, approaches_values, batch_number, sample_count, gen_cf_for, process_id, regression_min_diff, outcome, sat_options = {}, warm_start = False, multi_norm = False, time_budget = None):
+
+  multi_norm_explanations = {} # (dataset, model, approach, sample index) --> norm --> explanation
+
+  # IMPORTANT: a global time budget (in seconds) is shared evenly by all MACE
+  #            and MINT searches (one per sample, norm, and approach) that
+  #            remain, so that time saved on easy samples goes to harder ones.
+  #            Searches that run out of their share return their best
+  #            counterfactual so far, along with the optimality gap.
+  budget_deadline = time.time() + time_budget if time_budget is not None else None
+  remaining_sat_searches = \
+    len(dataset_values) * len(model_class_values) * len(norm_values) * sample_count * \
+    len([approach_string for approach_string in approaches_values if 'MACE' in approach_string or 'MINT' in approach_string])
 
   for dataset_string in dataset_values:
 
@@ -152,6 +212,9 @@ def runExperiments(dataset_values, model_class_values, norm_values, approaches_v
 
           print(f'\t\t\tExperimenting with approach_string = `{approach_string}`')
 
+          # encodings cached for the previous model are not needed any more
+          generateSATExplanations.clearFormulaCache()
+
           # if norm_type_string == 'two_norm':
           #   raise Exception(f'{norm_type_string} not supported.')
 
@@ -226,12 +289,38 @@ def runExperiments(dataset_values, model_class_values, norm_values, approaches_v
 
           # convert to dictionary for easier enumeration (iteration)
           iterate_over_data_dict = iterate_over_data_df.T.to_dict()
+
+          # number of searches (for the budget) that each sample accounts for
+          if 'MACE' not in approach_string and 'MINT' not in approach_string:
+            sat_searches_per_sample = 0
+          elif multi_norm:
+            sat_searches_per_sample = len(norm_values) if norm_type_string == norm_values[0] else 0
+          else:
+            sat_searches_per_sample = 1
+          remaining_sat_searches -= sat_searches_per_sample * max(sample_count - len(iterate_over_data_dict), 0)
           observable_data_dict = observable_data_df.T.to_dict()
 
+          # the LEAF approach explains all factual samples in one vectorized
+          # pass, whose explanations are then picked up sample by sample below
+          leaf_explanations = {}
+          if approach_string == 'LEAF':
+            leaf_explanations = dict(zip(
+              iterate_over_data_dict.keys(),
+              generateLeafExplanations.genExpForSamples(
+                [f'{explanation_folder_name}/sample_{factual_sample_index}.txt' for factual_sample_index in iterate_over_data_dict.keys()],
+                model_trained,
+                dataset_obj,
+                [dict(factual_sample, y = int(factual_sample['y'])) for factual_sample in iterate_over_data_dict.values()],
+                norm_type_string,
+                outcome = outcome
+              )
+            ))
+
           # loop through samples for which we desire a counterfactual,
           # (to be saved as part of the same file of minimum distances)
           explanation_counter = 1
           all_minimum_distances = {}
+          previous_counterfactual_samples = [] # warm start candidates for MACE
           for factual_sample_index, factual_sample in iterate_over_data_dict.items():
 
             factual_sample['y'] = int(factual_sample['y'])
@@ -245,18 +334,62 @@ def runExperiments(dataset_values, model_class_values, norm_values, approaches_v
             explanation_counter = explanation_counter + 1
             explanation_file_name = f'{explanation_folder_name}/sample_{factual_sample_index}.txt'
 
-            explanation_object = generateExplanations(
-              approach_string,
-              explanation_file_name,
-              model_trained,
-              dataset_obj,
-              factual_sample,
-              norm_type_string,
-              observable_data_dict, # used solely for minimum_observable method
-              standard_deviations, # used solely for feature_tweaking method
-              regression_min_diff,
-              outcome
-            )
+            # the closest observable sample and the counterfactuals of previous
+            # factual samples are cheap candidates to start the MACE search from
+            warm_start_samples = None
+            if warm_start and 'MACE' in approach_string:
+              closest_observable_sample = generateMOExplanations.findClosestObservableSample(
+                observable_data_dict,
+                dataset_obj,
+                factual_sample,
+                norm_type_string,
+                regression_min_diff)
+              warm_start_samples = [closest_observable_sample['sample']] + previous_counterfactual_samples
+
+            sample_sat_options = sat_options
+            if budget_deadline is not None and sat_searches_per_sample > 0:
+              sample_sat_options = dict(
+                sat_options,
+                time_budget = max(budget_deadline - time.time(), 0) * sat_searches_per_sample / max(remaining_sat_searches, sat_searches_per_sample))
+            remaining_sat_searches -= sat_searches_per_sample
+
+            if multi_norm and ('MACE' in approach_string or 'MINT' in approach_string):
+              # all norms are searched when the sample is first seen, and the
+              # explanations are picked up by the later norms' experiments
+              multi_norm_key = (dataset_string, model_class_string, approach_string, factual_sample_index)
+              if multi_norm_key not in multi_norm_explanations:
+                multi_norm_explanations[multi_norm_key] = generateExplanations(
+                  approach_string,
+                  explanation_file_name,
+                  model_trained,
+                  dataset_obj,
+                  factual_sample,
+                  list(norm_values),
+                  observable_data_dict,
+                  standard_deviations,
+                  regression_min_diff,
+                  outcome,
+                  sample_sat_options,
+                  warm_start_samples
+                )
+              explanation_object = multi_norm_explanations[multi_norm_key][norm_type_string]
+            elif factual_sample_index in leaf_explanations:
+              explanation_object = leaf_explanations[factual_sample_index]
+            else:
+              explanation_object = generateExplanations(
+                approach_string,
+                explanation_file_name,
+                model_trained,
+                dataset_obj,
+                factual_sample,
+                norm_type_string,
+                observable_data_dict, # used solely for minimum_observable method
+                standard_deviations, # used solely for feature_tweaking method
+                regression_min_diff,
+                outcome,
+                sample_sat_options,
+                warm_start_samples
+              )
 
             if 'MINT' in approach_string:
               print(
@@ -276,6 +409,17 @@ def runExperiments(dataset_values, model_class_values, norm_values, approaches_v
               ) # , file=log_file)
 
             all_minimum_distances[f'sample_{factual_sample_index}'] = explanation_object
+            if warm_start and 'MACE' in approach_string and explanation_object['cfe_found']:
+              previous_counterfactual_samples.append(explanation_object['cfe_sample'])
+
+          # which SMT backend answered first, for this dataset & model class
+          if 'MACE' in approach_string or 'MINT' in approach_string:
+            all_solver_wins = {}
+            for sample_explanation_object in all_minimum_distances.values():
+              for solver_name, solver_win_count in sample_explanation_object['search_solver_wins'].items():
+                all_solver_wins[solver_name] = all_solver_wins.get(solver_name, 0) + solver_win_count
+            print(f'\t\t\t\tSolver wins for `{model_class_string}`: {all_solver_wins}')
+            print(f'Solver wins for `{model_class_string}`: {all_solver_wins}', file=log_file)
 
           pickle.dump(all_minimum_distances, open(f'{experiment_folder_name}/_minimum_distances', 'wb'))
           pprint(all_minimum_distances, open(f'{experiment_folder_name}/minimum_distances.txt', 'w'))
@@ -311,7 +455,7 @@ if __name__ == '__main__':
       nargs = '+',
       type = str,
       default = 'MACE_eps_1e-5',
-      help = 'Approach used to generate counterfactual: MACE_eps_1e-3, MINT_eps_1e-3, MO, FT, AR.') # ES
+      help = 'Approach used to generate counterfactual: MACE_eps_1e-3, MINT_eps_1e-3, MACE_opt, MINT_opt, MO, FT, AR, MILP (lr, mlp), LEAF (tree).') # ES
 
   parser.add_argument(
       '-b', '--batch_number',
@@ -350,9 +494,91 @@ if __name__ == '__main__':
       help = 'Value of desired outcome for counterfactual.')
 
 
+  parser.add_argument(
+      '--solvers',
+      nargs = '+',
+      type = str,
+      default = ['z3'],
+      help = 'SMT backends used by MACE or MINT: z3, cvc4, yices, msat, picosat. If more than one is given, each query is raced on all of them in parallel.')
+
+  parser.add_argument(
+      '--num_workers',
+      type = int,
+      default = 1,
+      help = 'Number of worker processes used by MACE or MINT to test several distance thresholds in parallel.')
+
+  parser.add_argument(
+      '--bisection_arity',
+      type = int,
+      default = None,
+      help = 'Number of distance thresholds tested concurrently in each round of the parallel search (defaults to num_workers).')
+
+  parser.add_argument(
+      '--num_counterfactuals',
+      type = int,
+      default = 1,
+      help = 'Number of counterfactuals returned by MACE or MINT, each more than diversity_distance away from the previous ones (for zero_norm, each changing a different set of attributes).')
+
+  parser.add_argument(
+      '--diversity_distance',
+      type = float,
+      default = 0.01,
+      help = 'Minimum (normalized) distance between the counterfactuals returned by MACE or MINT when num_counterfactuals > 1.')
+
+  parser.add_argument(
+      '--iteration_timeout',
+      type = float,
+      default = None,
+      help = 'Time limit (in seconds) for each solver query of MACE or MINT (only enforced by z3).')
+
+  parser.add_argument(
+      '--time_budget',
+      type = float,
+      default = None,
+      help = 'Total time (in seconds) for all MACE or MINT searches, shared evenly across the remaining samples; searches that run out of time return their best counterfactual so far.')
+
+  parser.add_argument(
+      '--linear_distance',
+      action = 'store_true',
+      help = 'Encode distances of MACE or MINT in linear arithmetic: one_norm and infty_norm using auxiliary variables instead of Ite-based absolute values, and two_norm using lazily refined tangents of its squares (single solver and worker only). MACE_opt and MINT_opt always minimize the linear one_norm and infty_norm.')
+
+  parser.add_argument(
+      '--compact_encoding',
+      action = 'store_true',
+      help = 'Encode each one-hot categorical or ordinal attribute of MACE or MINT as a single Int symbol, and each binary attribute as a Bool symbol, instead of one symbol per sub-column.')
+
+  parser.add_argument(
+      '--tree_encoding',
+      type = str,
+      default = None,
+      help = 'Encoding of each decision tree (of a tree or forest model) used by MACE or MINT: nested, leaf_indicators (defaults to leaf_indicators only for trees too deep for the nested encoding).')
+
+  parser.add_argument(
+      '--warm_start',
+      action = 'store_true',
+      help = 'Start the MACE search from the closest valid counterfactual among the closest observable sample and the counterfactuals of previous samples.')
+
+  parser.add_argument(
+      '--multi_norm',
+      action = 'store_true',
+      help = 'Search all norms for each sample in one pass of MACE or MINT, sharing the encoding and solver; logs are saved in the experiment folder of the first norm.')
+
+
   # parsing the args
   args = parser.parse_args()
 
+  sat_options = {
+    'solver_names': args.solvers,
+    'num_workers': args.num_workers,
+    'bisection_arity': args.bisection_arity,
+    'num_counterfactuals': args.num_counterfactuals,
+    'diversity_distance': args.diversity_distance,
+    'iteration_timeout': args.iteration_timeout,
+    'linear_distance': args.linear_distance,
+    'compact_encoding': args.compact_encoding,
+    'tree_encoding': args.tree_encoding,
+  }
+
   if 'FT' in args.approach or 'PFT' in args.approach:
     assert len(args.model_class) == 1, 'FeatureTweaking approach only works with forests.'
     assert \
@@ -372,7 +598,11 @@ if __name__ == '__main__':
     args.gen_cf_for,
     args.process_id,
     args.regression_min_diff,
-    args.outcome)
+    args.outcome,
+    sat_options,
+    args.warm_start,
+    args.multi_norm,
+    args.time_budget)
 
 
 
@@ -0,0 +1,11 @@
+import pytest
+
+from pysmt.environment import reset_env
+
+
+@pytest.fixture(scope = 'module', autouse = True)
+def pysmtEnvironment():
+  # symbols are global to the pysmt environment, and the same symbol names
+  # (e.g., x1_counterfactual) have different types in different datasets
+  reset_env().enable_infix_notation = True
+  yield
@@ -0,0 +1,262 @@
+import time
+import numpy as np
+
+from sklearn.tree import _tree, DecisionTreeClassifier
+
+from generateMOExplanations import getPrettyStringForSampleDictionary
+from utils import getCanonicalSplitThreshold
+
+from random import seed
+RANDOM_SEED = 1122334455
+seed(RANDOM_SEED) # set the random seed so that the random permutations can be reproduced again
+np.random.seed(RANDOM_SEED)
+
+# IMPORTANT: a fitted decision tree partitions the input space into axis-aligned
+#            boxes, one per leaf. For a single tree, the nearest counterfactual
+#            is therefore the nearest point of any leaf box of another class;
+#            and since every supported norm is monotone in the per-feature
+#            differences, the nearest point of a box (intersected with the
+#            data range and actionability of each feature) is the factual
+#            sample clipped to the box, feature by feature. No search needed.
+LEAF_BOX_CACHE = {} # id(model_trained) --> (model_trained, leaf boxes)
+LEAF_BROADCAST_SIZE = 2 ** 16 # entries of the (samples, leaves, features) arrays scored at once
+
+
+def getLeafBoxes(model_trained, dataset_obj):
+  # returns (lower, upper, classes) where lower and upper are (num_leaves,
+  # num_features) arrays of the values attainable by each feature in each leaf,
+  # i.e., lower <= x <= upper, and classes is the prediction of each leaf.
+  if id(model_trained) in LEAF_BOX_CACHE:
+    return LEAF_BOX_CACHE[id(model_trained)][1]
+
+  tree_ = model_trained.tree_
+  num_features = len(dataset_obj.getInputAttributeNames('kurz'))
+
+  is_integer_based = [
+    dataset_obj.attributes_kurz[attr_name_kurz].attr_type != 'numeric-real' # refer to loadData.VALID_ATTRIBUTE_TYPES
+    for attr_name_kurz in dataset_obj.getInputAttributeNames('kurz')
+  ]
+
+  # sklearn goes left iff x <= threshold; on the way down, each leaf collects
+  # the tightest bounds threshold_right < x <= threshold_left per feature, on
+  # the same canonical thresholds as the SAT encoding (see
+  # utils.getCanonicalSplitThreshold), which account for the float32 cast.
+  # (iterative, as trees may be deeper than the recursion limit)
+  leaf_nodes, leaf_lower, leaf_upper = [], [], []
+  stack = [(0, np.full(num_features, -np.inf), np.full(num_features, np.inf))]
+  while stack:
+    node, lower, upper = stack.pop()
+    if tree_.children_left[node] == _tree.TREE_LEAF:
+      leaf_nodes.append(node)
+      leaf_lower.append(lower)
+      leaf_upper.append(upper)
+      continue
+    feature_idx = tree_.feature[node]
+    threshold = getCanonicalSplitThreshold(tree_.threshold[node], is_integer_based[feature_idx])
+    left_upper = upper.copy()
+    left_upper[feature_idx] = min(upper[feature_idx], threshold)
+    right_lower = lower.copy()
+    right_lower[feature_idx] = max(lower[feature_idx], threshold)
+    stack.append((tree_.children_right[node], right_lower, upper))
+    stack.append((tree_.children_left[node], lower, left_upper))
+  leaf_lower, leaf_upper = np.array(leaf_lower), np.array(leaf_upper)
+
+  # the exclusive lower bounds become inclusive ones: for integer-based
+  # features, the next integer; for real-based features, the next float64
+  # (every value above the canonical threshold goes right).
+  lower = np.where(is_integer_based, leaf_lower + 1, np.nextafter(leaf_lower, np.inf))
+  upper = leaf_upper
+  lower[np.isneginf(leaf_lower)] = -np.inf
+
+  classes = model_trained.classes_[np.argmax(tree_.value[leaf_nodes, 0, :], axis = 1)]
+
+  LEAF_BOX_CACHE[id(model_trained)] = (model_trained, (lower, upper, classes))
+  return lower, upper, classes
+
+
+def getFeasibleRanges(dataset_obj, factual_values):
+  # (num_samples, num_features) arrays of the values that each feature of the
+  # counterfactual may take: the data range, restricted by actionability +
+  # mutability (as for MACE, non-actionable features are fixed).
+  lower = np.empty(factual_values.shape)
+  upper = np.empty(factual_values.shape)
+  for idx, attr_name_kurz in enumerate(dataset_obj.getInputAttributeNames('kurz')):
+    attr_obj = dataset_obj.attributes_kurz[attr_name_kurz]
+    lower[:, idx] = attr_obj.lower_bound
+    upper[:, idx] = attr_obj.upper_bound
+    if attr_obj.mutability == False or attr_obj.actionability == 'none':
+      lower[:, idx] = upper[:, idx] = factual_values[:, idx]
+    elif attr_obj.actionability == 'same-or-increase':
+      lower[:, idx] = np.maximum(lower[:, idx], factual_values[:, idx])
+    elif attr_obj.actionability == 'same-or-decrease':
+      upper[:, idx] = np.minimum(upper[:, idx], factual_values[:, idx])
+  return lower, upper
+
+
+def getNormalizedDistances(normalized_absolute_distances, norm_type):
+  # as in normalizedDistance.getDistanceBetweenSamples, over the last axis
+  num_terms = normalized_absolute_distances.shape[-1]
+  if norm_type == 'zero_norm':
+    return np.count_nonzero(normalized_absolute_distances, axis = -1) / num_terms
+  elif norm_type == 'one_norm':
+    return np.sum(normalized_absolute_distances, axis = -1) / num_terms
+  elif norm_type == 'two_norm':
+    return np.sqrt(np.sum(normalized_absolute_distances ** 2, axis = -1) / num_terms)
+  elif norm_type == 'infty_norm':
+    return np.max(normalized_absolute_distances, axis = -1) / num_terms
+  else:
+    raise Exception(f'{norm_type} not recognized as a valid `norm_type`.')
+
+
+def findClosestCounterfactualSamples(model_trained, dataset_obj, factual_samples, norm_type, outcome=None):
+  # the nearest counterfactual of each factual sample, as a list of
+  # (counterfactual_sample, distance) pairs; counterfactual_sample is {} if
+  # there is none. The leaves of the target class are scored against a chunk
+  # of samples at once, as (num_samples, num_leaves, num_features) arrays.
+  attr_names_kurz = dataset_obj.getInputAttributeNames('kurz')
+  mutable_attributes = dataset_obj.getMutableAttributeNames('kurz')
+  mutable_idx = [idx for idx, attr_name_kurz in enumerate(attr_names_kurz) if attr_name_kurz in mutable_attributes]
+  feature_ranges = np.array([
+    dataset_obj.attributes_kurz[attr_name_kurz].upper_bound - dataset_obj.attributes_kurz[attr_name_kurz].lower_bound
+    for attr_name_kurz in attr_names_kurz
+  ], dtype = float)
+
+  factual_values = np.array([[factual_sample[attr_name_kurz] for attr_name_kurz in attr_names_kurz] for factual_sample in factual_samples], dtype = float).reshape(-1, len(attr_names_kurz))
+  factual_labels = np.array([factual_sample['y'] for factual_sample in factual_samples])
+  feasible_lower, feasible_upper = getFeasibleRanges(dataset_obj, factual_values)
+  leaf_lower, leaf_upper, leaf_classes = getLeafBoxes(model_trained, dataset_obj)
+
+  closest_counterfactual_values = np.zeros(factual_values.shape)
+  closest_counterfactual_labels = np.zeros(factual_labels.shape, dtype = leaf_classes.dtype)
+  closest_distances = np.full(len(factual_samples), np.inf)
+
+  # samples with the same label share the leaves they may end up in
+  for factual_label in np.unique(factual_labels):
+    is_target_leaf = leaf_classes != factual_label # meaning we want the decision to be different.
+    if outcome is not None:
+      is_target_leaf &= leaf_classes == outcome # we desire a specific outcome
+    target_leaf_idx = np.flatnonzero(is_target_leaf)
+    if len(target_leaf_idx) == 0:
+      continue
+    sample_idx = np.flatnonzero(factual_labels == factual_label)
+    chunk_size = max(1, LEAF_BROADCAST_SIZE // (len(target_leaf_idx) * len(attr_names_kurz)))
+    for chunk_idx in [sample_idx[i : i + chunk_size] for i in range(0, len(sample_idx), chunk_size)]:
+      lower = np.maximum(leaf_lower[np.newaxis, target_leaf_idx, :], feasible_lower[chunk_idx, np.newaxis, :])
+      upper = np.minimum(leaf_upper[np.newaxis, target_leaf_idx, :], feasible_upper[chunk_idx, np.newaxis, :])
+      counterfactual_values = np.minimum(np.maximum(factual_values[chunk_idx, np.newaxis, :], lower), upper)
+      normalized_absolute_distances = np.abs(counterfactual_values - factual_values[chunk_idx, np.newaxis, :])[:, :, mutable_idx] / feature_ranges[mutable_idx]
+      distances = np.where(
+        np.all(lower <= upper, axis = 2),
+        getNormalizedDistances(normalized_absolute_distances, norm_type),
+        np.inf
+      )
+      closest_leaf_idx = np.argmin(distances, axis = 1)
+      closest_counterfactual_values[chunk_idx] = counterfactual_values[np.arange(len(chunk_idx)), closest_leaf_idx]
+      closest_counterfactual_labels[chunk_idx] = leaf_classes[target_leaf_idx[closest_leaf_idx]]
+      closest_distances[chunk_idx] = distances[np.arange(len(chunk_idx)), closest_leaf_idx]
+
+  closest_counterfactual_samples = []
+  for sample_idx in range(len(factual_samples)):
+    if closest_distances[sample_idx] == np.inf:
+      closest_counterfactual_samples.append(({}, np.infty))
+      continue
+    counterfactual_sample = {}
+    for idx, attr_name_kurz in enumerate(attr_names_kurz):
+      value = closest_counterfactual_values[sample_idx, idx]
+      if dataset_obj.attributes_kurz[attr_name_kurz].attr_type == 'numeric-real':
+        counterfactual_sample[attr_name_kurz] = float(value)
+      else:
+        counterfactual_sample[attr_name_kurz] = int(value)
+    counterfactual_sample['y'] = closest_counterfactual_labels[sample_idx].item()
+    closest_counterfactual_samples.append((counterfactual_sample, float(closest_distances[sample_idx])))
+  return closest_counterfactual_samples
+
+
+def genExpForSamples(
+  explanation_file_names,
+  model_trained,
+  dataset_obj,
+  factual_samples,
+  norm_type,
+  outcome=None):
+
+  if not isinstance(model_trained, DecisionTreeClassifier):
+    raise Exception(f'{type(model_trained).__name__} not supported by the LEAF approach.')
+  if dataset_obj.is_one_hot:
+    raise Exception('The LEAF approach does not support one-hot encoded datasets.')
+
+  start_time = time.time()
+
+  closest_counterfactual_samples = findClosestCounterfactualSamples(
+    model_trained,
+    dataset_obj,
+    factual_samples,
+    norm_type,
+    outcome=outcome
+  )
+
+  # verify the leaf predictions against sklearn
+  attr_names_kurz = dataset_obj.getInputAttributeNames('kurz')
+  found_idx = [idx for idx, (counterfactual_sample, _) in enumerate(closest_counterfactual_samples) if counterfactual_sample]
+  sklearn_predictions = {}
+  if len(found_idx) > 0:
+    vectorized_samples = [
+      [closest_counterfactual_samples[idx][0][attr_name_kurz] for attr_name_kurz in attr_names_kurz]
+      for idx in found_idx
+    ]
+    sklearn_predictions = dict(zip(found_idx, model_trained.predict(vectorized_samples)))
+
+  end_time = time.time()
+
+  explanations = []
+  for idx, (explanation_file_name, factual_sample) in enumerate(zip(explanation_file_names, factual_samples)):
+    counterfactual_sample, counterfactual_distance = closest_counterfactual_samples[idx]
+    counterfactual_found = idx in sklearn_predictions and sklearn_predictions[idx] == counterfactual_sample['y']
+    if len(counterfactual_sample) == 0:
+      search_status = 'infeasible'
+    else:
+      search_status = 'complete' if counterfactual_found else 'halted'
+
+    log_file = open(explanation_file_name,'w')
+    print('\n', file=log_file)
+    print(f"Factual sample: \t\t {getPrettyStringForSampleDictionary(factual_sample, dataset_obj)}", file=log_file)
+    print(f"Nearest counterfactual sample:\t {getPrettyStringForSampleDictionary(counterfactual_sample, dataset_obj)} ({'verified' if counterfactual_found else 'not verified'})", file=log_file)
+    print(f"Minimum counterfactual distance: {counterfactual_distance:.6f}", file=log_file)
+    print(f"Search status:\t\t\t {search_status} ({len(getLeafBoxes(model_trained, dataset_obj)[2])} leaves, batch of {len(factual_samples)} samples, {end_time - start_time:.4f}s)", file=log_file)
+    log_file.close()
+
+    explanations.append({
+      'fac_sample': factual_sample,
+      'cfe_found': counterfactual_found,
+      'cfe_plausible': counterfactual_found,
+      'cfe_time': (end_time - start_time) / len(factual_samples),
+      'cfe_sample': counterfactual_sample,
+      'cfe_distance': counterfactual_distance,
+      'search_status': search_status,
+      'search_iterations': 1,
+      'search_solver_time': (end_time - start_time) / len(factual_samples),
+      'search_lower_bound': counterfactual_distance if counterfactual_found else 0,
+      'search_upper_bound': counterfactual_distance if counterfactual_found else 1,
+      'optimality_gap': 0 if counterfactual_found else 1,
+      'search_solver_wins': {'leaf': 1},
+    })
+
+  return explanations
+
+
+def genExp(
+  explanation_file_name,
+  model_trained,
+  dataset_obj,
+  factual_sample,
+  norm_type,
+  outcome=None):
+
+  return genExpForSamples(
+    [explanation_file_name],
+    model_trained,
+    dataset_obj,
+    [factual_sample],
+    norm_type,
+    outcome=outcome
+  )[0]
@@ -0,0 +1,328 @@
+import time
+import numpy as np
+
+import normalizedDistance
+
+from scipy.optimize import milp, Bounds, LinearConstraint
+from sklearn.linear_model import LogisticRegression
+from sklearn.neural_network import MLPClassifier
+
+from utils import getMLPPreactivationBounds
+
+from generateMOExplanations import getPrettyStringForSampleDictionary
+
+from random import seed
+RANDOM_SEED = 1122334455
+seed(RANDOM_SEED) # set the random seed so that the random permutations can be reproduced again
+np.random.seed(RANDOM_SEED)
+
+# IMPORTANT: sklearn's LogisticRegression.predict() returns class 1 iff
+#            np.dot(coef_, sample) + intercept_ > 0 (see lr2formula). A MILP
+#            can only express non-strict inequalities, and HiGHS satisfies them
+#            up to its feasibility tolerance; therefore the score is kept this
+#            far on the desired side of the decision boundary, and the final
+#            prediction is verified against sklearn.
+SCORE_MARGIN = 1e-6
+
+
+def getDistanceTerms(dataset_obj):
+  # one term per summand of normalizedDistance.getDistanceBetweenSamples; each
+  # term is a list of (attr_name_kurz, scale) pairs whose signed, scaled
+  # differences to the factual sample are bound by the term's aux variable:
+  #   - mutable non-hot: d >= |x - f| / range
+  #   - mutable categorical group: d >= |x_i - f_i| for every sibling; for
+  #     one-hot vectors, this is 0 if all siblings are equal, and 1 otherwise.
+  #   - mutable ordinal group: d >= |sum_i (x_i - f_i)| / len(siblings); for
+  #     thermometer vectors, this equals sum_i |x_i - f_i| / len(siblings).
+  distance_terms = []
+
+  mutable_attributes = dataset_obj.getMutableAttributeNames('kurz')
+  one_hot_attributes = dataset_obj.getOneHotAttributesNames('kurz')
+  non_hot_attributes = dataset_obj.getNonHotAttributesNames('kurz')
+
+  for attr_name_kurz in np.intersect1d(mutable_attributes, non_hot_attributes):
+    attr_obj = dataset_obj.attributes_kurz[attr_name_kurz]
+    distance_terms.append([
+      [(attr_name_kurz, 1 / (attr_obj.upper_bound - attr_obj.lower_bound))]
+    ])
+
+  already_considered = []
+  for attr_name_kurz in np.intersect1d(mutable_attributes, one_hot_attributes):
+    if attr_name_kurz not in already_considered:
+      siblings_kurz = dataset_obj.getSiblingsFor(attr_name_kurz)
+      if 'cat' in dataset_obj.attributes_kurz[attr_name_kurz].attr_type:
+        distance_terms.append([
+          [(sibling_kurz, 1)]
+          for sibling_kurz in siblings_kurz
+        ])
+      elif 'ord' in dataset_obj.attributes_kurz[attr_name_kurz].attr_type:
+        distance_terms.append([
+          [(sibling_kurz, 1 / len(siblings_kurz)) for sibling_kurz in siblings_kurz]
+        ])
+      else:
+        raise Exception(f'{attr_name_kurz} must include either `cat` or `ord`.')
+      already_considered.extend(siblings_kurz)
+
+  return distance_terms
+
+
+def addVariable(milp_problem, lower_bound, upper_bound, integral=False):
+  milp_problem['lower_bounds'].append(float(lower_bound))
+  milp_problem['upper_bounds'].append(float(upper_bound))
+  milp_problem['integrality'].append(1 if integral else 0)
+  return len(milp_problem['lower_bounds']) - 1
+
+
+def addRow(milp_problem, coefficients, lower_bound, upper_bound):
+  # coefficients is a list of (variable_idx, coefficient) pairs
+  milp_problem['rows'].append(coefficients)
+  milp_problem['row_lower_bounds'].append(lower_bound)
+  milp_problem['row_upper_bounds'].append(upper_bound)
+
+
+def getInputMILP(dataset_obj, factual_sample, norm_type):
+  # variables 0, ..., n-1 are the counterfactual sample (in the order of
+  # getInputAttributeNames, i.e., of the model's inputs), followed by one
+  # variable per distance term, and (for the infty_norm only) an upper bound on
+  # all distance terms. The model is added on top by addLRToMILP / addMLPToMILP.
+  milp_problem = {
+    'lower_bounds': [],
+    'upper_bounds': [],
+    'integrality': [],
+    'rows': [],
+    'row_lower_bounds': [],
+    'row_upper_bounds': [],
+    'objective': [],
+  }
+  attr_names_kurz = dataset_obj.getInputAttributeNames('kurz')
+  attr_index = {attr_name_kurz: idx for idx, attr_name_kurz in enumerate(attr_names_kurz)}
+  factual_values = {attr_name_kurz: float(factual_sample[attr_name_kurz]) for attr_name_kurz in attr_names_kurz}
+
+  ## 1. data range plausibility + 3. actionability + mutability
+  for attr_name_kurz in attr_names_kurz:
+    attr_obj = dataset_obj.attributes_kurz[attr_name_kurz]
+    lower_bound = attr_obj.lower_bound
+    upper_bound = attr_obj.upper_bound
+    # IMPORTANT: as in generateSATExplanations for MACE, there are no causal
+    #            assumptions here, so a mutable but non-actionable variable is
+    #            as fixed as an immutable one.
+    if attr_obj.mutability == False or attr_obj.actionability == 'none':
+      lower_bound = upper_bound = factual_values[attr_name_kurz]
+    elif attr_obj.actionability == 'same-or-increase':
+      lower_bound = max(lower_bound, factual_values[attr_name_kurz])
+    elif attr_obj.actionability == 'same-or-decrease':
+      upper_bound = min(upper_bound, factual_values[attr_name_kurz])
+    addVariable(
+      milp_problem,
+      lower_bound,
+      upper_bound,
+      integral = attr_obj.attr_type != 'numeric-real' # refer to loadData.VALID_ATTRIBUTE_TYPES
+    )
+
+  ## 2. data type plausibility
+  if dataset_obj.is_one_hot:
+    dict_of_siblings_kurz = dataset_obj.getDictOfSiblings('kurz')
+    for siblings_kurz in dict_of_siblings_kurz['cat'].values():
+      addRow(milp_problem, [(attr_index[sibling_kurz], 1) for sibling_kurz in siblings_kurz], 1, 1)
+    for siblings_kurz in dict_of_siblings_kurz['ord'].values():
+      for symbol_idx in range(len(siblings_kurz) - 1): # already sorted
+        addRow(milp_problem, [(attr_index[siblings_kurz[symbol_idx]], 1), (attr_index[siblings_kurz[symbol_idx + 1]], -1)], 0, np.inf)
+
+  ## distance: d_j >= +/- sum (x_i - f_i) * scale_i  <=>  +/- sum x_i * scale_i - d_j <= +/- sum f_i * scale_i
+  if norm_type not in {'zero_norm', 'one_norm', 'infty_norm'}:
+    raise Exception(f'{norm_type} not supported by the MILP approach; expected zero_norm, one_norm, or infty_norm.')
+  distance_terms = getDistanceTerms(dataset_obj)
+  term_indices = [
+    addVariable(milp_problem, 0, 1, integral = norm_type == 'zero_norm') # for the zero_norm, a term is either changed or not
+    for term in distance_terms
+  ]
+  for term_idx, term in zip(term_indices, distance_terms):
+    for differences in term:
+      factual_offset = sum(factual_values[attr_name_kurz] * scale for attr_name_kurz, scale in differences)
+      for sign in [1, -1]:
+        addRow(
+          milp_problem,
+          [(attr_index[attr_name_kurz], sign * scale) for attr_name_kurz, scale in differences] + [(term_idx, -1)],
+          -np.inf,
+          sign * factual_offset
+        )
+
+  if norm_type == 'infty_norm':
+    max_term_idx = addVariable(milp_problem, 0, 1)
+    for term_idx in term_indices:
+      addRow(milp_problem, [(term_idx, 1), (max_term_idx, -1)], -np.inf, 0)
+    milp_problem['objective'].append((max_term_idx, 1 / len(term_indices)))
+  else:
+    milp_problem['objective'].extend([(term_idx, 1 / len(term_indices)) for term_idx in term_indices])
+
+  return milp_problem
+
+
+def addScoreToMILP(milp_problem, coefficients, intercept, outcome):
+  # the decision must be different: the score sum(coefficients) + intercept is
+  # positive for class 1 and not positive for class 0 (see lr2formula)
+  if outcome == 1:
+    addRow(milp_problem, coefficients, SCORE_MARGIN - intercept, np.inf)
+  else:
+    addRow(milp_problem, coefficients, -np.inf, - SCORE_MARGIN - intercept)
+
+
+def addLRToMILP(milp_problem, model, outcome):
+  coefficients = [(idx, float(weight)) for idx, weight in enumerate(model.coef_[0])]
+  addScoreToMILP(milp_problem, coefficients, float(model.intercept_[0]), outcome)
+
+
+def addMLPToMILP(milp_problem, model, outcome):
+  # IMPORTANT: each unstable ReLU h = max(z, 0), with l <= z <= u and l < 0 < u,
+  #            is encoded with a binary phase indicator a and big-M constants
+  #            taken from interval bound propagation:
+  #              h >= z,  h <= z - l (1 - a),  h <= u a,  h >= 0
+  #            Stable ReLUs need neither the indicator nor the constraints, and
+  #            since the bounds are propagated from the variable bounds of the
+  #            counterfactual (i.e., after actionability + mutability have
+  #            pinned or halved the range of the factual's features), many more
+  #            ReLUs are stable than over the whole data range.
+  num_inputs = model.coefs_[0].shape[0]
+  input_bounds = list(zip(milp_problem['lower_bounds'][:num_inputs], milp_problem['upper_bounds'][:num_inputs]))
+  preactivation_bounds = getMLPPreactivationBounds(model, input_bounds)
+
+  # the previous layer's outputs, each as a list of (variable_idx, coefficient)
+  # pairs and a constant
+  previous_layer = [([(idx, 1)], 0) for idx in range(num_inputs)]
+  for interlayer_idx in range(len(model.coefs_)):
+    weights = model.coefs_[interlayer_idx]
+    current_layer = []
+    for feature_idx in range(weights.shape[1]):
+      coefficients = []
+      constant = float(model.intercepts_[interlayer_idx][feature_idx])
+      for prev_feature_idx, (prev_coefficients, prev_constant) in enumerate(previous_layer):
+        weight = float(weights[prev_feature_idx, feature_idx])
+        coefficients.extend([(idx, weight * coefficient) for idx, coefficient in prev_coefficients])
+        constant += weight * prev_constant
+      current_layer.append((coefficients, constant))
+
+    if interlayer_idx == len(model.coefs_) - 1:
+      # sklearn's MLPClassifier has a logistic output, i.e., no ReLU; class 1
+      # is predicted iff the pre-activation of the output is positive.
+      coefficients, constant = current_layer[0]
+      addScoreToMILP(milp_problem, coefficients, constant, outcome)
+      break
+
+    pre_lower, pre_upper = preactivation_bounds[interlayer_idx]
+    previous_layer = []
+    for feature_idx, (coefficients, constant) in enumerate(current_layer):
+      if pre_upper[feature_idx] <= 0: # stable, inactive
+        previous_layer.append(([], 0))
+        continue
+      pre_idx = addVariable(milp_problem, pre_lower[feature_idx], pre_upper[feature_idx])
+      addRow(milp_problem, coefficients + [(pre_idx, -1)], - constant, - constant)
+      if pre_lower[feature_idx] >= 0: # stable, active
+        previous_layer.append(([(pre_idx, 1)], 0))
+        continue
+      post_idx = addVariable(milp_problem, 0, pre_upper[feature_idx])
+      phase_idx = addVariable(milp_problem, 0, 1, integral = True)
+      addRow(milp_problem, [(post_idx, 1), (pre_idx, -1)], 0, np.inf)
+      addRow(milp_problem, [(post_idx, 1), (pre_idx, -1), (phase_idx, - pre_lower[feature_idx])], -np.inf, - pre_lower[feature_idx])
+      addRow(milp_problem, [(post_idx, 1), (phase_idx, - pre_upper[feature_idx])], -np.inf, 0)
+      previous_layer.append(([(post_idx, 1)], 0))
+
+
+def getScipyMILPArguments(milp_problem):
+  num_variables = len(milp_problem['lower_bounds'])
+  objective = np.zeros(num_variables)
+  for idx, coefficient in milp_problem['objective']:
+    objective[idx] += coefficient
+  constraint_matrix = np.zeros((len(milp_problem['rows']), num_variables))
+  for row_idx, coefficients in enumerate(milp_problem['rows']):
+    for idx, coefficient in coefficients:
+      constraint_matrix[row_idx, idx] += coefficient
+  return {
+    'c': objective,
+    'integrality': np.array(milp_problem['integrality']),
+    'bounds': Bounds(milp_problem['lower_bounds'], milp_problem['upper_bounds']),
+    'constraints': LinearConstraint(constraint_matrix, milp_problem['row_lower_bounds'], milp_problem['row_upper_bounds']),
+  }
+
+
+def getSearchStatus(milp_result, counterfactual_found):
+  # same vocabulary as the search_stats of generateSATExplanations
+  if milp_result.status == 0:
+    return 'complete' if counterfactual_found else 'halted'
+  elif milp_result.status == 1:
+    return 'timeout'
+  elif milp_result.status == 2:
+    return 'infeasible'
+  return 'unknown'
+
+
+def genExp(
+  explanation_file_name,
+  model_trained,
+  dataset_obj,
+  factual_sample,
+  norm_type,
+  outcome=None):
+
+  if not isinstance(model_trained, LogisticRegression) and not isinstance(model_trained, MLPClassifier):
+    raise Exception(f'{type(model_trained).__name__} not supported by the MILP approach.')
+  if dataset_obj.problem_type != 'classification' or dataset_obj.n_classes != 2:
+    raise Exception('The MILP approach only supports binary classification.')
+
+  start_time = time.time()
+
+  log_file = open(explanation_file_name,'w')
+
+  if outcome is None:
+    outcome = 1 - int(factual_sample['y'])
+  milp_problem = getInputMILP(dataset_obj, factual_sample, norm_type)
+  if isinstance(model_trained, LogisticRegression):
+    addLRToMILP(milp_problem, model_trained, outcome)
+  elif isinstance(model_trained, MLPClassifier):
+    addMLPToMILP(milp_problem, model_trained, outcome)
+  milp_arguments = getScipyMILPArguments(milp_problem)
+  solver_start_time = time.time()
+  milp_result = milp(**milp_arguments)
+  solver_time = time.time() - solver_start_time
+
+  counterfactual_sample = {}
+  counterfactual_found = False
+  counterfactual_distance = np.infty
+  if milp_result.x is not None:
+    for idx, attr_name_kurz in enumerate(dataset_obj.getInputAttributeNames('kurz')):
+      if milp_problem['integrality'][idx]:
+        counterfactual_sample[attr_name_kurz] = int(np.round(milp_result.x[idx]))
+      else:
+        counterfactual_sample[attr_name_kurz] = float(milp_result.x[idx])
+    vectorized_sample = [counterfactual_sample[attr_name_kurz] for attr_name_kurz in dataset_obj.getInputAttributeNames('kurz')]
+    counterfactual_sample['y'] = int(model_trained.predict([vectorized_sample])[0])
+    counterfactual_found = counterfactual_sample['y'] != factual_sample['y']
+    counterfactual_distance = normalizedDistance.getDistanceBetweenSamples(
+      factual_sample,
+      counterfactual_sample,
+      norm_type,
+      dataset_obj
+    )
+
+  print('\n', file=log_file)
+  print(f"Factual sample: \t\t {getPrettyStringForSampleDictionary(factual_sample, dataset_obj)}", file=log_file)
+  print(f"Nearest counterfactual sample:\t {getPrettyStringForSampleDictionary(counterfactual_sample, dataset_obj)} ({'verified' if counterfactual_found else 'not verified'})", file=log_file)
+  print(f"Minimum counterfactual distance: {counterfactual_distance:.6f}", file=log_file)
+  print(f"Search status:\t\t\t {getSearchStatus(milp_result, counterfactual_found)} ({milp_result.message}; {len(milp_problem['lower_bounds'])} variables, {len(milp_problem['rows'])} constraints, {milp_result.mip_node_count} nodes, {solver_time:.4f}s)", file=log_file)
+
+  end_time = time.time()
+
+  return {
+    'fac_sample': factual_sample,
+    'cfe_found': counterfactual_found,
+    'cfe_plausible': counterfactual_found,
+    'cfe_time': end_time - start_time,
+    'cfe_sample': counterfactual_sample,
+    'cfe_distance': counterfactual_distance,
+    'search_status': getSearchStatus(milp_result, counterfactual_found),
+    'search_iterations': milp_result.mip_node_count,
+    'search_solver_time': solver_time,
+    'search_lower_bound': milp_result.mip_dual_bound if milp_result.x is not None else 0,
+    'search_upper_bound': milp_result.fun if milp_result.x is not None else 1,
+    'optimality_gap': milp_result.mip_gap if milp_result.x is not None else 1,
+    'search_solver_wins': {'highs': 1},
+  }
@@ -3,14 +3,22 @@ import os
 import time
 import copy
 import pickle
+import hashlib
+from collections import OrderedDict
+from fractions import Fraction
 import numpy as np
 import pandas as pd
+import z3
 import normalizedDistance
 
 from modelConversion import *
+from parallelSolvers import SolverPool, SolverPortfolio, SolverWorkersFailedError, getAvailableSolverNames, setSolverTimeout
 from utils import round_decimals_up
 from pysmt.shortcuts import *
 from pysmt.typing import *
+from pysmt.exceptions import SolverReturnedUnknownResultError
+from pysmt.solvers.z3 import Z3Converter, Z3Model
+from pysmt.walkers import IdentityDagWalker
 from pprint import pprint
 
 from sklearn.tree import DecisionTreeClassifier, DecisionTreeRegressor
@@ -30,13 +38,16 @@ np.random.seed(RANDOM_SEED)
 # DEBUG_FLAG = True
 DEBUG_FLAG = False
 
-def getModelFormula(model_symbols, model_trained):
+def getModelFormula(model_symbols, model_trained, feature_domains=None, tree_encoding=None):
+  # feature_domains (for trees and forests only) prunes splits and subtrees
+  # that cannot be reached by a given factual sample's counterfactuals, and
+  # tree_encoding (idem) is one of modelConversion.TREE_ENCODINGS
   if isinstance(model_trained, DecisionTreeClassifier) or isinstance(model_trained, DecisionTreeRegressor):
-    model2formula = lambda a,b : tree2formula(a,b)
+    model2formula = lambda a,b : tree2formula(a,b, tree_encoding=tree_encoding, feature_domains=feature_domains)
   elif isinstance(model_trained, LogisticRegression):
     model2formula = lambda a,b : lr2formula(a,b)
   elif isinstance(model_trained, RandomForestClassifier) or isinstance(model_trained, RandomForestRegressor):
-    model2formula = lambda a,b : forest2formula(a,b)
+    model2formula = lambda a,b : forest2formula(a,b, feature_domains=feature_domains, tree_encoding=tree_encoding)
   elif isinstance(model_trained, MLPClassifier) or isinstance(model_trained, MLPRegressor):
     model2formula = lambda a,b : mlp2formula(a,b)
 
@@ -45,6 +56,251 @@ def getModelFormula(model_symbols, model_trained):
     model_symbols)
 
 
+def getDistanceTermCount(dataset_obj):
+  # number of terms in the distance (one per mutable non-hot attribute, and
+  # one per group of mutable one-hot siblings); see getDistanceExpression
+  mutable_attributes = dataset_obj.getMutableAttributeNames('kurz')
+  one_hot_attributes = dataset_obj.getOneHotAttributesNames('kurz')
+  non_hot_attributes = dataset_obj.getNonHotAttributesNames('kurz')
+  sibling_groups = set(
+    tuple(dataset_obj.getSiblingsFor(attr_name_kurz))
+    for attr_name_kurz in np.intersect1d(mutable_attributes, one_hot_attributes)
+  )
+  return len(np.intersect1d(mutable_attributes, non_hot_attributes)) + len(sibling_groups)
+
+
+def getCounterfactualInputBounds(model_symbols, dataset_obj, factual_sample, approach_string):
+  # (lower, upper) bounds of each counterfactual input of a factual sample:
+  # immutable (and, for MACE, non-actionable) inputs are fixed to their factual
+  # value, and monotone inputs can only move in one direction (see
+  # getPlausibilityFormula)
+  input_bounds = {}
+  for attr_name_kurz, attr_symbols in model_symbols['counterfactual'].items():
+    attr_obj = dataset_obj.attributes_kurz[attr_name_kurz]
+    lower_bound = float(attr_symbols['lower_bound'].constant_value())
+    upper_bound = float(attr_symbols['upper_bound'].constant_value())
+    factual_value = float(factual_sample[attr_name_kurz].constant_value())
+    if attr_obj.mutability == False or (attr_obj.actionability == 'none' and 'mace' in approach_string):
+      lower_bound, upper_bound = factual_value, factual_value
+    elif attr_obj.actionability == 'same-or-increase':
+      lower_bound = factual_value
+    elif attr_obj.actionability == 'same-or-decrease':
+      upper_bound = factual_value
+    input_bounds[attr_name_kurz] = (lower_bound, upper_bound)
+  return input_bounds
+
+
+def getModelPhaseFormula(model_symbols, model_trained, dataset_obj, factual_sample, approach_string, norm_type=None, norm_threshold=None):
+  # IMPORTANT: the model formula is the same for all factual samples, but the
+  #            counterfactual inputs of a given sample are often confined to a
+  #            much smaller box (see getCounterfactualInputBounds). Below a
+  #            MACE distance threshold t, each of the n normalized distance
+  #            terms is also at most n * t (or sqrt(n) * t for two_norm).
+  #            Propagating this box through an MLP proves many more ReLUs
+  #            stable, whose case splits are then decided up front.
+  if not (isinstance(model_trained, MLPClassifier) or isinstance(model_trained, MLPRegressor)):
+    return TRUE()
+
+  max_normalized_difference = np.inf
+  if norm_threshold is not None and 'mace' in approach_string:
+    if norm_type in {'one_norm', 'infty_norm'}:
+      max_normalized_difference = getDistanceTermCount(dataset_obj) * norm_threshold * (1 + 1e-9)
+    elif norm_type == 'two_norm':
+      max_normalized_difference = np.sqrt(getDistanceTermCount(dataset_obj)) * norm_threshold * (1 + 1e-9)
+  non_hot_attributes = dataset_obj.getNonHotAttributesNames('kurz')
+
+  input_bounds = []
+  for attr_name_kurz, (lower_bound, upper_bound) in getCounterfactualInputBounds(model_symbols, dataset_obj, factual_sample, approach_string).items():
+    attr_obj = dataset_obj.attributes_kurz[attr_name_kurz]
+    attr_symbols = model_symbols['counterfactual'][attr_name_kurz]
+    attr_range = float(attr_symbols['upper_bound'].constant_value()) - float(attr_symbols['lower_bound'].constant_value())
+    factual_value = float(factual_sample[attr_name_kurz].constant_value())
+    if attr_name_kurz in non_hot_attributes and np.isfinite(max_normalized_difference):
+      max_difference = max_normalized_difference * attr_range
+      lower_bound = max(lower_bound, factual_value - max_difference)
+      upper_bound = min(upper_bound, factual_value + max_difference)
+    elif 'cat' in attr_obj.attr_type and max_normalized_difference < 1:
+      # the term of a categorical attribute is either 0 or 1
+      lower_bound, upper_bound = factual_value, factual_value
+    input_bounds.append((lower_bound, upper_bound))
+
+  return mlp2phaseformula(model_trained, model_symbols, input_bounds)
+
+
+# IMPORTANT: the model formula (e.g., tens of thousands of nodes for a forest)
+#            and the factual-independent plausibility constraints are the same
+#            for every factual sample in a batch. They are therefore built once
+#            and cached, keyed by a hash of the trained model and/or dataset
+#            schema. Because pysmt symbols are identified by name and type, the
+#            cached formulas refer to the same symbols created by later genExp
+#            calls. Call clearFormulaCache() when moving on to another model.
+FORMULA_CACHE = {}
+MODEL_HASHES = {} # id(model_trained) --> (model_trained, hash)
+
+# IMPORTANT: many factual samples share the values of their pinned (immutable
+#            or, for MACE, non-actionable) features. Model formulas specialized
+#            to such a signature (see getSpecializedModelFormula) are kept in a
+#            bounded LRU cache, so that these samples reuse a smaller encoding.
+SPECIALIZED_FORMULA_CACHE_SIZE = 32
+SPECIALIZED_FORMULA_CACHE = OrderedDict() # key --> (formula, aux symbols, DAG node count)
+SPECIALIZED_FORMULA_CACHE_STATS = {'hits': 0, 'misses': 0}
+
+
+def clearFormulaCache():
+  FORMULA_CACHE.clear()
+  MODEL_HASHES.clear()
+  SPECIALIZED_FORMULA_CACHE.clear()
+  SPECIALIZED_FORMULA_CACHE_STATS['hits'] = 0
+  SPECIALIZED_FORMULA_CACHE_STATS['misses'] = 0
+
+
+def getDatasetSchemaHash(dataset_obj):
+  schema = [dataset_obj.dataset_name, dataset_obj.is_one_hot]
+  for attr_name_kurz in dataset_obj.getInputOutputAttributeNames('kurz'):
+    attr_obj = dataset_obj.attributes_kurz[attr_name_kurz]
+    schema.append((
+      attr_name_kurz,
+      attr_obj.attr_type,
+      attr_obj.lower_bound,
+      attr_obj.upper_bound,
+      attr_obj.mutability,
+      attr_obj.actionability,
+    ))
+  return hashlib.sha1(str(schema).encode()).hexdigest()
+
+
+def getModelHash(model_trained):
+  # keep a reference to the model so that its id is not re-used by another one
+  if id(model_trained) not in MODEL_HASHES:
+    MODEL_HASHES[id(model_trained)] = (model_trained, hashlib.sha1(pickle.dumps(model_trained)).hexdigest())
+  return MODEL_HASHES[id(model_trained)][1]
+
+
+def getSymbolEncodingString(model_symbols):
+  # formulas over the compact encoding of the inputs (see getCompactInputSymbols)
+  # must not be mixed up with those over the default encoding
+  if any(len(compact_symbols) > 0 for compact_symbols in model_symbols['compact'].values()):
+    return 'compact'
+  return 'default'
+
+
+def getCachedModelFormula(model_symbols, model_trained, dataset_obj, tree_encoding=None):
+  cache_key = ('model', getModelHash(model_trained), getDatasetSchemaHash(dataset_obj), getSymbolEncodingString(model_symbols), tree_encoding)
+  if cache_key not in FORMULA_CACHE:
+    model_formula = getModelFormula(model_symbols, model_trained, tree_encoding=tree_encoding)
+    FORMULA_CACHE[cache_key] = (model_formula, model_symbols.get('aux'))
+  model_formula, aux_symbols = FORMULA_CACHE[cache_key]
+  if aux_symbols is not None:
+    model_symbols['aux'] = aux_symbols
+  return model_formula
+
+
+def getCachedFactualIndependentPlausibilityFormula(model_symbols, dataset_obj):
+  cache_key = ('plausibility', getDatasetSchemaHash(dataset_obj), tuple(getInputSymbolTypes(model_symbols)), getSymbolEncodingString(model_symbols))
+  if cache_key not in FORMULA_CACHE:
+    FORMULA_CACHE[cache_key] = getFactualIndependentPlausibilityFormula(model_symbols, dataset_obj)
+  return FORMULA_CACHE[cache_key]
+
+
+def getFormulaNodeCount(formula):
+  # number of distinct (hash-consed) nodes of the formula DAG
+  visited = set()
+  stack = [formula]
+  while len(stack) > 0:
+    node = stack.pop()
+    if node in visited:
+      continue
+    visited.add(node)
+    stack.extend(node.args())
+  return len(visited)
+
+
+def getConstantFoldedFormula(formula):
+  # folds the constant subterms of a formula (e.g., the products of pinned
+  # inputs and their weights) without otherwise reordering its sums the way
+  # simplify() does, which z3 was found to handle worse on MLPs; nodes are
+  # rebuilt from their (folded) args by pysmt's own identity walker, which
+  # reads payloads such as function names through the public API
+  node_builder = IdentityDagWalker(env=get_env())
+  folded_nodes = {}
+  stack = [formula]
+  while len(stack) > 0:
+    node = stack[-1]
+    if node in folded_nodes:
+      stack.pop()
+      continue
+    unfolded_args = [arg for arg in node.args() if arg not in folded_nodes]
+    if len(unfolded_args) > 0:
+      stack.extend(unfolded_args)
+      continue
+    stack.pop()
+    args = [folded_nodes[arg] for arg in node.args()]
+    if len(args) > 0 and all(arg.is_constant() for arg in args):
+      folded_node = node_builder.functions[node.node_type()](node, args=args).simplify()
+    elif node.is_plus() and sum(arg.is_constant() for arg in args) > 1:
+      constant_args = [arg for arg in args if arg.is_constant()]
+      folded_node = Plus([Plus(constant_args).simplify()] + [arg for arg in args if not arg.is_constant()])
+    elif node.is_ite() and args[0].is_constant():
+      folded_node = args[1] if args[0].is_true() else args[2]
+    elif args != list(node.args()):
+      folded_node = node_builder.functions[node.node_type()](node, args=args)
+    else:
+      folded_node = node
+    folded_nodes[node] = folded_node
+  return folded_nodes[formula]
+
+
+def getSpecializedModelFormula(model_symbols, model_trained, dataset_obj, factual_sample, feature_domains, log_file, cache_formulas=True, tree_encoding=None):
+  # model formula specialized to the feature domains of a factual sample (see
+  # getCounterfactualInputBounds): trees and forests are rebuilt without the
+  # splits these domains decide, whereas the pinned inputs of LR and MLP models
+  # are substituted by their factual value and constant-folded out of the
+  # (first-layer) sums over them
+  is_tree_model = isinstance(model_trained, (DecisionTreeClassifier, DecisionTreeRegressor, RandomForestClassifier, RandomForestRegressor))
+  if not is_tree_model:
+    feature_domains = {
+      attr_name_kurz: (lower_bound, upper_bound)
+      for attr_name_kurz, (lower_bound, upper_bound) in feature_domains.items()
+      if lower_bound == upper_bound
+    }
+  if len(feature_domains) == 0:
+    if cache_formulas:
+      return getCachedModelFormula(model_symbols, model_trained, dataset_obj, tree_encoding)
+    return getModelFormula(model_symbols, model_trained, tree_encoding=tree_encoding)
+
+  cache_key = (getModelHash(model_trained), getDatasetSchemaHash(dataset_obj), getSymbolEncodingString(model_symbols), tree_encoding, tuple(sorted(feature_domains.items())))
+  if cache_key in SPECIALIZED_FORMULA_CACHE:
+    SPECIALIZED_FORMULA_CACHE_STATS['hits'] += 1
+    SPECIALIZED_FORMULA_CACHE.move_to_end(cache_key)
+    cache_status = 'hit'
+  else:
+    SPECIALIZED_FORMULA_CACHE_STATS['misses'] += 1
+    cache_status = 'miss'
+    if is_tree_model:
+      model_formula = getModelFormula(model_symbols, model_trained, feature_domains, tree_encoding)
+    else:
+      if cache_formulas:
+        model_formula = getCachedModelFormula(model_symbols, model_trained, dataset_obj)
+      else:
+        model_formula = getModelFormula(model_symbols, model_trained)
+      model_formula = model_formula.substitute({
+        model_symbols['counterfactual'][attr_name_kurz]['symbol']: factual_sample[attr_name_kurz]
+        for attr_name_kurz in feature_domains.keys()
+      })
+      model_formula = getConstantFoldedFormula(model_formula)
+    SPECIALIZED_FORMULA_CACHE[cache_key] = (model_formula, model_symbols.get('aux'), getFormulaNodeCount(model_formula))
+    while len(SPECIALIZED_FORMULA_CACHE) > SPECIALIZED_FORMULA_CACHE_SIZE:
+      SPECIALIZED_FORMULA_CACHE.popitem(last = False)
+  model_formula, aux_symbols, node_count = SPECIALIZED_FORMULA_CACHE[cache_key]
+  if aux_symbols is not None:
+    model_symbols['aux'] = aux_symbols
+
+  num_lookups = SPECIALIZED_FORMULA_CACHE_STATS['hits'] + SPECIALIZED_FORMULA_CACHE_STATS['misses']
+  cached_node_count = sum(entry[2] for entry in SPECIALIZED_FORMULA_CACHE.values())
+  print(f'[specialized model formula: {node_count} nodes, cache {cache_status}; hit rate {SPECIALIZED_FORMULA_CACHE_STATS["hits"]}/{num_lookups}, {len(SPECIALIZED_FORMULA_CACHE)} formulas with {cached_node_count} nodes cached]\t', end = '', file = log_file)
+  return model_formula
+
+
 def getClassificationCounterfactualFormula(model_symbols, factual_sample, outcome=None):
   cf_formula = NotEquals(
     model_symbols['output']['y']['symbol'],
@@ -83,7 +339,7 @@ def getAbsoluteDifference(symbol_1, symbol_2):
     Minus(ToReal(symbol_2), ToReal(symbol_1))
   )
 
-def getDistanceFormula(model_symbols, dataset_obj, factual_sample, norm_type, approach_string, norm_threshold):
+def getDistanceExpression(model_symbols, dataset_obj, factual_sample, norm_type, approach_string):
 
   if 'mace' in approach_string:
     variable_to_compute_distance_on = 'counterfactual'
@@ -259,51 +515,373 @@ def getDistanceFormula(model_symbols, dataset_obj, factual_sample, norm_type, ap
   # We use 1 / len(normalized_absolute_distances) below because we only consider
   # those attributes that are mutable, and for each sibling-group (ord, cat)
   # we only consider 1 entry in the normalized_absolute_distances
+  # IMPORTANT: the expression below does not depend on the norm threshold, so it
+  #            is built once per factual sample and then compared against the
+  #            changing threshold in getDistanceThresholdFormula. For two_norm,
+  #            the expression is the (normalized) squared distance.
   if norm_type == 'zero_norm':
-    distance_formula = LE(
+    distance_expression = Times(
+      Real(1 / len(normalized_absolute_distances)),
+      Plus([
+        Ite(
+          Equals(elem, Real(0)),
+          Real(0),
+          Real(1)
+        ) for elem in normalized_absolute_distances
+      ])
+    )
+  elif norm_type == 'one_norm':
+    distance_expression = Times(
+      Real(1 / len(normalized_absolute_distances)),
+      ToReal(Plus(normalized_absolute_distances))
+    )
+  elif norm_type == 'two_norm':
+    distance_expression = Times(
+      Real(1 / len(normalized_squared_distances)),
+      ToReal(Plus(normalized_squared_distances))
+    )
+  elif norm_type == 'infty_norm':
+    distance_expression = Times(
+      Real(1 / len(normalized_absolute_distances)),
+      ToReal(Max(normalized_absolute_distances))
+    )
+  else:
+    raise Exception(f'{norm_type} not recognized as a valid `norm_type`.')
+
+  return distance_expression
+
+
+def getLinearDistanceExpression(model_symbols, dataset_obj, factual_sample, norm_type, approach_string):
+  # IMPORTANT: an alternative to getDistanceExpression for one_norm and
+  #            infty_norm, without Ite-based absolute values (and Max). Each
+  #            absolute difference is replaced by an auxiliary variable d that
+  #            is only bounded from below, d >= x - x_F and d >= x_F - x, and
+  #            the range normalization by a precomputed reciprocal constant, so
+  #            that the distance is a linear combination of the d's. The
+  #            returned expression is therefore an upper bound of the distance
+  #            that is tight at its minimum, which is all that is needed for
+  #            `distance <= threshold` queries and for minimizing the distance
+  #            (but not, e.g., for `distance > threshold`). The constraints on
+  #            the auxiliary variables are returned alongside the expression.
+  if norm_type not in {'one_norm', 'infty_norm'}:
+    raise Exception(f'{norm_type} cannot be linearized; use the Ite-based distance expression instead.')
+
+  if 'mace' in approach_string:
+    variable_to_compute_distance_on = 'counterfactual'
+  elif 'mint' in approach_string:
+    variable_to_compute_distance_on = 'interventional'
+
+  mutable_attributes = dataset_obj.getMutableAttributeNames('kurz')
+  one_hot_attributes = dataset_obj.getOneHotAttributesNames('kurz')
+  non_hot_attributes = dataset_obj.getNonHotAttributesNames('kurz')
+
+  normalized_absolute_distances = []
+  distance_constraints = []
+
+  def getAbsoluteDifferenceSymbol(name, symbol_1, symbol_2):
+    abs_diff_symbol = Symbol(f'{name}_{variable_to_compute_distance_on}_abs_diff', REAL)
+    distance_constraints.append(GE(abs_diff_symbol, Minus(ToReal(symbol_1), ToReal(symbol_2))))
+    distance_constraints.append(GE(abs_diff_symbol, Minus(ToReal(symbol_2), ToReal(symbol_1))))
+    return abs_diff_symbol
+
+  # 1. mutable & non-hot
+  for attr_name_kurz in np.intersect1d(mutable_attributes, non_hot_attributes):
+    attr_symbols = model_symbols[variable_to_compute_distance_on][attr_name_kurz]
+    attr_range = Fraction(attr_symbols['upper_bound'].constant_value()) - Fraction(attr_symbols['lower_bound'].constant_value())
+    normalized_absolute_distances.append(
       Times(
-        Real(1 / len(normalized_absolute_distances)),
-        Plus([
+        Real(1 / attr_range),
+        getAbsoluteDifferenceSymbol(
+          attr_name_kurz,
+          attr_symbols['symbol'],
+          factual_sample[attr_name_kurz]
+        )
+      )
+    )
+
+  # 2. mutable & integer-based & one-hot
+  already_considered = []
+  for attr_name_kurz in np.intersect1d(mutable_attributes, one_hot_attributes):
+    if attr_name_kurz not in already_considered:
+      siblings_kurz = dataset_obj.getSiblingsFor(attr_name_kurz)
+      if 'cat' in dataset_obj.attributes_kurz[attr_name_kurz].attr_type:
+        # a single Ite over Booleans, rather than over arithmetic
+        normalized_absolute_distances.append(
           Ite(
-            Equals(elem, Real(0)),
+            And([
+              EqualsOrIff(
+                model_symbols[variable_to_compute_distance_on][sibling_name_kurz]['symbol'],
+                factual_sample[sibling_name_kurz]
+              )
+              for sibling_name_kurz in siblings_kurz
+            ]),
             Real(0),
             Real(1)
-          ) for elem in normalized_absolute_distances
-        ])
-      ),
-      Real(norm_threshold)
+          )
+        )
+      elif 'ord' in dataset_obj.attributes_kurz[attr_name_kurz].attr_type:
+        normalized_absolute_distances.append(
+          Times(
+            Real(Fraction(1, len(siblings_kurz))),
+            getAbsoluteDifferenceSymbol(
+              attr_name_kurz,
+              Plus([
+                model_symbols[variable_to_compute_distance_on][sibling_name_kurz]['symbol']
+                for sibling_name_kurz in siblings_kurz
+              ]),
+              Plus([
+                factual_sample[sibling_name_kurz]
+                for sibling_name_kurz in siblings_kurz
+              ])
+            )
+          )
+        )
+      else:
+        raise Exception(f'{attr_name_kurz} must include either `cat` or `ord`.')
+      already_considered.extend(siblings_kurz)
+
+  if norm_type == 'one_norm':
+    distance_expression = Times(
+      Real(Fraction(1, len(normalized_absolute_distances))),
+      Plus(normalized_absolute_distances)
     )
-  elif norm_type == 'one_norm':
-    distance_formula = LE(
-      Times(
-        Real(1 / len(normalized_absolute_distances)),
-        ToReal(Plus(normalized_absolute_distances))
-      ),
-      Real(norm_threshold)
+  elif norm_type == 'infty_norm':
+    max_symbol = Symbol(f'max_{variable_to_compute_distance_on}_abs_diff', REAL)
+    distance_constraints.extend(
+      GE(max_symbol, normalized_absolute_distance)
+      for normalized_absolute_distance in normalized_absolute_distances
     )
-  elif norm_type == 'two_norm':
-    distance_formula = LE(
-      Times(
-        Real(1 / len(normalized_squared_distances)),
-        ToReal(Plus(normalized_squared_distances))
-      ),
+    distance_expression = Times(
+      Real(Fraction(1, len(normalized_absolute_distances))),
+      max_symbol
+    )
+
+  return distance_expression, And(distance_constraints)
+
+
+def getLinearSquaredDistanceExpression(model_symbols, dataset_obj, factual_sample, approach_string):
+  # IMPORTANT: a linear relaxation of the two_norm distance expression, which
+  #            otherwise needs non-linear real arithmetic. Each squared
+  #            normalized difference u^2 is replaced by an auxiliary variable s
+  #            that is only bounded from below by tangents of the (convex)
+  #            square, s >= 2 a u - a^2, at a few points a in [-1, 1]. The
+  #            expression under-approximates the distance, so UNSAT answers to
+  #            `distance <= threshold` queries are final, and SAT answers are
+  #            final once s >= u^2 holds at the solution; otherwise, the
+  #            relaxation is refined by the tangents at the solution (see
+  #            getSquaredDistanceTangentCuts). Returns the expression, the
+  #            initial tangent constraints, and the (s, u) pairs.
+  if 'mace' in approach_string:
+    variable_to_compute_distance_on = 'counterfactual'
+  elif 'mint' in approach_string:
+    variable_to_compute_distance_on = 'interventional'
+
+  mutable_attributes = dataset_obj.getMutableAttributeNames('kurz')
+  one_hot_attributes = dataset_obj.getOneHotAttributesNames('kurz')
+  non_hot_attributes = dataset_obj.getNonHotAttributesNames('kurz')
+
+  normalized_squared_distances = []
+  squared_differences = []
+
+  def getSquaredDifferenceSymbol(name, normalized_difference):
+    squared_difference_symbol = Symbol(f'{name}_{variable_to_compute_distance_on}_sq_diff', REAL)
+    squared_differences.append((squared_difference_symbol, normalized_difference))
+    return squared_difference_symbol
+
+  # 1. mutable & non-hot
+  for attr_name_kurz in np.intersect1d(mutable_attributes, non_hot_attributes):
+    attr_symbols = model_symbols[variable_to_compute_distance_on][attr_name_kurz]
+    attr_range = Fraction(attr_symbols['upper_bound'].constant_value()) - Fraction(attr_symbols['lower_bound'].constant_value())
+    normalized_squared_distances.append(
+      getSquaredDifferenceSymbol(
+        attr_name_kurz,
+        Times(
+          Real(1 / attr_range),
+          Minus(ToReal(attr_symbols['symbol']), ToReal(factual_sample[attr_name_kurz]))
+        )
+      )
+    )
+
+  # 2. mutable & integer-based & one-hot
+  already_considered = []
+  for attr_name_kurz in np.intersect1d(mutable_attributes, one_hot_attributes):
+    if attr_name_kurz not in already_considered:
+      siblings_kurz = dataset_obj.getSiblingsFor(attr_name_kurz)
+      if 'cat' in dataset_obj.attributes_kurz[attr_name_kurz].attr_type:
+        # as the distance is 0 or 1 in this case, the square is the same
+        normalized_squared_distances.append(
+          Ite(
+            And([
+              EqualsOrIff(
+                model_symbols[variable_to_compute_distance_on][sibling_name_kurz]['symbol'],
+                factual_sample[sibling_name_kurz]
+              )
+              for sibling_name_kurz in siblings_kurz
+            ]),
+            Real(0),
+            Real(1)
+          )
+        )
+      elif 'ord' in dataset_obj.attributes_kurz[attr_name_kurz].attr_type:
+        normalized_squared_distances.append(
+          getSquaredDifferenceSymbol(
+            attr_name_kurz,
+            Times(
+              Real(Fraction(1, len(siblings_kurz))),
+              ToReal(
+                Minus(
+                  Plus([
+                    model_symbols[variable_to_compute_distance_on][sibling_name_kurz]['symbol']
+                    for sibling_name_kurz in siblings_kurz
+                  ]),
+                  Plus([
+                    factual_sample[sibling_name_kurz]
+                    for sibling_name_kurz in siblings_kurz
+                  ])
+                )
+              )
+            )
+          )
+        )
+      else:
+        raise Exception(f'{attr_name_kurz} must include either `cat` or `ord`.')
+      already_considered.extend(siblings_kurz)
+
+  distance_expression = Times(
+    Real(Fraction(1, len(normalized_squared_distances))),
+    Plus(normalized_squared_distances)
+  )
+  distance_constraints = And([
+    getSquaredDifferenceTangent(squared_difference_symbol, normalized_difference, Fraction(tangent_point))
+    for (squared_difference_symbol, normalized_difference) in squared_differences
+    for tangent_point in (-1, Fraction(-1, 2), 0, Fraction(1, 2), 1)
+  ])
+
+  return distance_expression, distance_constraints, squared_differences
+
+
+def getSquaredDifferenceTangent(squared_difference_symbol, normalized_difference, tangent_point):
+  # s >= a^2 + 2 a (u - a), the tangent of u^2 at a
+  return GE(
+    squared_difference_symbol,
+    Minus(Times(Real(2 * tangent_point), normalized_difference), Real(tangent_point ** 2))
+  )
+
+
+def getSquaredDistanceTangentCuts(model, squared_differences):
+  # the tangents at the solution, for those squares that it underestimates;
+  # the tangent points are rounded to floats, as the digits of exact ones (and
+  # of the next solutions) would otherwise double with every refinement
+  tangent_cuts = []
+  for (squared_difference_symbol, normalized_difference) in squared_differences:
+    normalized_difference_value = Fraction(model.get_value(normalized_difference).constant_value())
+    if Fraction(model.get_value(squared_difference_symbol).constant_value()) < normalized_difference_value ** 2:
+      tangent_cuts.append(getSquaredDifferenceTangent(squared_difference_symbol, normalized_difference, Fraction(float(normalized_difference_value))))
+  return tangent_cuts
+
+
+def getSquaredDistanceValue(model, distance_expression, squared_differences):
+  # the (squared) two_norm distance of a solution to the relaxation, with the
+  # squares evaluated in floating point (exact squares of the solution's
+  # rationals can have thousands of digits)
+  return float(model.get_value(distance_expression.substitute({
+    squared_difference_symbol: Real(float(model.get_value(normalized_difference).constant_value()) ** 2)
+    for (squared_difference_symbol, normalized_difference) in squared_differences
+  })).constant_value())
+
+
+def getDistanceThresholdFormula(distance_expression, norm_type, norm_threshold):
+  if norm_type == 'two_norm':
+    return LE(
+      distance_expression,
       Pow(
         Real(norm_threshold),
         Real(2)
       )
     )
-  elif norm_type == 'infty_norm':
-    distance_formula = LE(
-      Times(
-        Real(1 / len(normalized_absolute_distances)),
-        ToReal(Max(normalized_absolute_distances))
-      ),
+  else:
+    return LE(
+      distance_expression,
       Real(norm_threshold)
     )
-  else:
-    raise Exception(f'{norm_type} not recognized as a valid `norm_type`.')
 
-  return distance_formula
+
+def getDistanceFormula(model_symbols, dataset_obj, factual_sample, norm_type, approach_string, norm_threshold):
+  return getDistanceThresholdFormula(
+    getDistanceExpression(model_symbols, dataset_obj, factual_sample, norm_type, approach_string),
+    norm_type,
+    norm_threshold
+  )
+
+
+def getChangedLiterals(model_symbols, dataset_obj, factual_sample, approach_string):
+  # IMPORTANT: the zero_norm distance only takes the values k / n, where n is
+  #            the number of (mutable) distance terms of getDistanceExpression.
+  #            Instead of comparing Ite sums against a real threshold, each term
+  #            gets a Boolean literal that is true iff the term has changed, and
+  #            the number of true literals is bounded by an integer k.
+  if 'mace' in approach_string:
+    variable_to_compute_distance_on = 'counterfactual'
+  elif 'mint' in approach_string:
+    variable_to_compute_distance_on = 'interventional'
+
+  mutable_attributes = dataset_obj.getMutableAttributeNames('kurz')
+  one_hot_attributes = dataset_obj.getOneHotAttributesNames('kurz')
+  non_hot_attributes = dataset_obj.getNonHotAttributesNames('kurz')
+
+  unchanged_formulas = {} # literal name --> formula that holds iff unchanged
+
+  # 1. mutable & non-hot
+  for attr_name_kurz in np.intersect1d(mutable_attributes, non_hot_attributes):
+    unchanged_formulas[attr_name_kurz] = EqualsOrIff(
+      model_symbols[variable_to_compute_distance_on][attr_name_kurz]['symbol'],
+      factual_sample[attr_name_kurz]
+    )
+
+  # 2. mutable & integer-based & one-hot (one literal per sibling group)
+  already_considered = []
+  for attr_name_kurz in np.intersect1d(mutable_attributes, one_hot_attributes):
+    if attr_name_kurz not in already_considered:
+      siblings_kurz = dataset_obj.getSiblingsFor(attr_name_kurz)
+      if 'cat' in dataset_obj.attributes_kurz[attr_name_kurz].attr_type:
+        unchanged_formulas[attr_name_kurz] = And([
+          EqualsOrIff(
+            model_symbols[variable_to_compute_distance_on][sibling_name_kurz]['symbol'],
+            factual_sample[sibling_name_kurz]
+          )
+          for sibling_name_kurz in siblings_kurz
+        ])
+      elif 'ord' in dataset_obj.attributes_kurz[attr_name_kurz].attr_type:
+        unchanged_formulas[attr_name_kurz] = Equals(
+          Plus([
+            model_symbols[variable_to_compute_distance_on][sibling_name_kurz]['symbol']
+            for sibling_name_kurz in siblings_kurz
+          ]),
+          Plus([
+            factual_sample[sibling_name_kurz]
+            for sibling_name_kurz in siblings_kurz
+          ])
+        )
+      else:
+        raise Exception(f'{attr_name_kurz} must include either `cat` or `ord`.')
+      already_considered.extend(siblings_kurz)
+
+  changed_literals = [
+    Symbol(f'{literal_name}_{variable_to_compute_distance_on}_changed', BOOL)
+    for literal_name in unchanged_formulas.keys()
+  ]
+  changed_formula = And([
+    Iff(changed_literal, Not(unchanged_formula))
+    for changed_literal, unchanged_formula in zip(changed_literals, unchanged_formulas.values())
+  ])
+  return changed_literals, changed_formula
+
+
+def getCardinalityFormula(changed_literals, max_changed):
+  return LE(
+    Plus([Ite(changed_literal, Int(1), Int(0)) for changed_literal in changed_literals]),
+    Int(max_changed)
+  )
 
 
 def getCausalConsistencyConstraints(model_symbols, dataset_obj, factual_sample):
@@ -319,40 +897,58 @@ def getCausalConsistencyConstraints(model_symbols, dataset_obj, factual_sample):
     return getTestCausalConsistencyConstraints(model_symbols, factual_sample)
 
 
-def getPlausibilityFormula(model_symbols, dataset_obj, factual_sample, approach_string):
-  # here is where the user specifies the following:
-  #  1. data range plausibility
-  #  2. data type plausibility
-  #  3. actionability + mutability
-  #  4. causal consistency
+def getInputSymbolTypes(model_symbols):
+  # the types of input symbols defined for an approach (see genExp)
+  return [
+    symbol_type
+    for symbol_type in ['counterfactual', 'interventional']
+    if len(model_symbols[symbol_type]) > 0
+  ]
+
+
+def getFactualIndependentPlausibilityFormula(model_symbols, dataset_obj):
+  # constraints 1 and 2 of getPlausibilityFormula below, which only depend on
+  # the dataset (and not on the factual sample), and can therefore be cached
 
   ##############################################################################
   ## 1. data range plausibility
   ##############################################################################
-  range_plausibility_counterfactual = And([
+  # IMPORTANT: a weird behavior of print(get_model(formula)) is that if there is
+  #            a variable that is defined as a symbol, but is not constrained in
+  #            the formula, then print(.) will not print the "verifying" value of
+  #            that variable (as it can be anything). Therefore, we always use
+  #            range plausibility constraints on ALL variables. Interventional
+  #            variables are only defined (see genExp) for MINT, and not MACE.
+  #            In the compact encoding, the range of the compact symbols (see
+  #            getCompactInputSymbols) implies that of the terms derived from
+  #            them. TODO: find alternative method to print(model).
+  range_plausibility = And([
     And(
-      GE(model_symbols['counterfactual'][attr_name_kurz]['symbol'], model_symbols['counterfactual'][attr_name_kurz]['lower_bound']),
-      LE(model_symbols['counterfactual'][attr_name_kurz]['symbol'], model_symbols['counterfactual'][attr_name_kurz]['upper_bound'])
+      GE(model_symbols[symbol_type][attr_name_kurz]['symbol'], model_symbols[symbol_type][attr_name_kurz]['lower_bound']),
+      LE(model_symbols[symbol_type][attr_name_kurz]['symbol'], model_symbols[symbol_type][attr_name_kurz]['upper_bound'])
     )
+    for symbol_type in getInputSymbolTypes(model_symbols)
     for attr_name_kurz in dataset_obj.getInputAttributeNames('kurz')
-  ])
-  range_plausibility_interventional = And([
+    if model_symbols[symbol_type][attr_name_kurz]['symbol'].is_symbol()
+  ] + [
     And(
-      GE(model_symbols['interventional'][attr_name_kurz]['symbol'], model_symbols['interventional'][attr_name_kurz]['lower_bound']),
-      LE(model_symbols['interventional'][attr_name_kurz]['symbol'], model_symbols['interventional'][attr_name_kurz]['upper_bound'])
+      GE(compact_symbols['symbol'], compact_symbols['lower_bound']),
+      LE(compact_symbols['symbol'], compact_symbols['upper_bound'])
     )
-    for attr_name_kurz in dataset_obj.getInputAttributeNames('kurz')
+    for symbol_type in getInputSymbolTypes(model_symbols)
+    for compact_symbols in model_symbols['compact'][symbol_type].values()
+    if compact_symbols['symbol'].symbol_type() == INT
+  ] + [
+    # the categories between the bounds may not all be allowed
+    Or([
+      Equals(compact_symbols['symbol'], Int(category_idx))
+      for category_idx in compact_symbols['categories']
+    ])
+    for symbol_type in getInputSymbolTypes(model_symbols)
+    for compact_symbols in model_symbols['compact'][symbol_type].values()
+    if 'categories' in compact_symbols
   ])
 
-  # IMPORTANT: a weird behavior of print(get_model(formula)) is that if there is
-  #            a variable that is defined as a symbol, but is not constrained in
-  #            the formula, then print(.) will not print the "verifying" value of
-  #            that variable (as it can be anything). Therefore, we always use
-  #            range plausibility constraints on ALL variables (including the
-  #            interventional variables, even though they are only used for MINT
-  #            and not MACE). TODO: find alternative method to print(model).
-  range_plausibility = And([range_plausibility_counterfactual, range_plausibility_interventional])
-
 
   ##############################################################################
   ## 2. data type plausibility
@@ -368,24 +964,17 @@ def getPlausibilityFormula(model_symbols, dataset_obj, factual_sample, approach_
 
       onehot_categorical_plausibility = And(
         onehot_categorical_plausibility,
-        And(
-          EqualsOrIff(
-            Plus([
-              model_symbols['counterfactual'][attr_name_kurz]['symbol']
-              for attr_name_kurz in dict_of_siblings_kurz['cat'][parent_name_kurz]
-            ]),
-            Int(1)
-          )
-        ),
-        And(
+        And([
           EqualsOrIff(
             Plus([
-              model_symbols['interventional'][attr_name_kurz]['symbol']
+              model_symbols[symbol_type][attr_name_kurz]['symbol']
               for attr_name_kurz in dict_of_siblings_kurz['cat'][parent_name_kurz]
             ]),
             Int(1)
           )
-        )
+          for symbol_type in getInputSymbolTypes(model_symbols)
+          if parent_name_kurz not in model_symbols['compact'][symbol_type] # else, implied by the encoding
+        ])
       )
 
     for parent_name_kurz in dict_of_siblings_kurz['ord'].keys():
@@ -394,16 +983,11 @@ def getPlausibilityFormula(model_symbols, dataset_obj, factual_sample, approach_
         onehot_ordinal_plausibility,
         And([
           GE(
-            ToReal(model_symbols['counterfactual'][dict_of_siblings_kurz['ord'][parent_name_kurz][symbol_idx]]['symbol']),
-            ToReal(model_symbols['counterfactual'][dict_of_siblings_kurz['ord'][parent_name_kurz][symbol_idx + 1]]['symbol'])
-          )
-          for symbol_idx in range(len(dict_of_siblings_kurz['ord'][parent_name_kurz]) - 1) # already sorted
-        ]),
-        And([
-          GE(
-            ToReal(model_symbols['interventional'][dict_of_siblings_kurz['ord'][parent_name_kurz][symbol_idx]]['symbol']),
-            ToReal(model_symbols['interventional'][dict_of_siblings_kurz['ord'][parent_name_kurz][symbol_idx + 1]]['symbol'])
+            ToReal(model_symbols[symbol_type][dict_of_siblings_kurz['ord'][parent_name_kurz][symbol_idx]]['symbol']),
+            ToReal(model_symbols[symbol_type][dict_of_siblings_kurz['ord'][parent_name_kurz][symbol_idx + 1]]['symbol'])
           )
+          for symbol_type in getInputSymbolTypes(model_symbols)
+          if parent_name_kurz not in model_symbols['compact'][symbol_type] # else, implied by the encoding
           for symbol_idx in range(len(dict_of_siblings_kurz['ord'][parent_name_kurz]) - 1) # already sorted
         ])
       )
@@ -429,6 +1013,26 @@ def getPlausibilityFormula(model_symbols, dataset_obj, factual_sample, approach_
       #   for symbol_idx_ahead in range(1, len(dict_of_siblings_kurz['ord'][parent_name_kurz])) # already sorted
       # ])
 
+  return And(
+    range_plausibility,
+    onehot_categorical_plausibility,
+    onehot_ordinal_plausibility
+  )
+
+
+def getPlausibilityFormula(model_symbols, dataset_obj, factual_sample, approach_string, factual_independent_plausibility=None):
+  # here is where the user specifies the following:
+  #  1. data range plausibility
+  #  2. data type plausibility
+  #  3. actionability + mutability
+  #  4. causal consistency
+
+  ##############################################################################
+  ## 1. data range plausibility + 2. data type plausibility
+  ##############################################################################
+  if factual_independent_plausibility is None:
+    factual_independent_plausibility = getFactualIndependentPlausibilityFormula(model_symbols, dataset_obj)
+
 
   ##############################################################################
   ## 3. actionability + mutability
@@ -444,39 +1048,28 @@ def getPlausibilityFormula(model_symbols, dataset_obj, factual_sample, approach_
     if attr_obj.mutability == True and attr_obj.actionability != 'none':
 
       if attr_obj.actionability == 'same-or-increase':
-        actionability_mutability_plausibility.append(GE(
-          model_symbols['counterfactual'][attr_name_kurz]['symbol'],
-          factual_sample[attr_name_kurz]
-        ))
-        actionability_mutability_plausibility.append(GE(
-          model_symbols['interventional'][attr_name_kurz]['symbol'],
-          factual_sample[attr_name_kurz]
-        ))
+        actionability_mutability_plausibility.extend([
+          GE(model_symbols[symbol_type][attr_name_kurz]['symbol'], factual_sample[attr_name_kurz])
+          for symbol_type in getInputSymbolTypes(model_symbols)
+        ])
       elif attr_obj.actionability == 'same-or-decrease':
-        actionability_mutability_plausibility.append(LE(
-          model_symbols['counterfactual'][attr_name_kurz]['symbol'],
-          factual_sample[attr_name_kurz]
-        ))
-        actionability_mutability_plausibility.append(LE(
-          model_symbols['interventional'][attr_name_kurz]['symbol'],
-          factual_sample[attr_name_kurz]
-        ))
+        actionability_mutability_plausibility.extend([
+          LE(model_symbols[symbol_type][attr_name_kurz]['symbol'], factual_sample[attr_name_kurz])
+          for symbol_type in getInputSymbolTypes(model_symbols)
+        ])
       elif attr_obj.actionability == 'any':
         continue
 
     # b) mutable but non-actionable: interventional value cannot change, but counterfactual value can
     elif attr_obj.mutability == True and attr_obj.actionability == 'none':
 
-      # IMPORTANT: when we are optimizing for nearest CFE, we completely ignore
-      #            the interventional symbols, even though they are defined. In
-      #            such a world, we also don't have any assumptions about the
+      # IMPORTANT: when we are optimizing for nearest CFE, there are no
+      #            interventional symbols (see genExp). In such a world, we also don't have any assumptions about the
       #            causal structure, and therefore, causal_consistency = TRUE()
       #            later in the code. Therefore, a `mutable but actionable` var
       #            (i.e., a variable that can change due to it's ancerstors) does
       #            not even exist. Thus, non-actionable variables are supported
       #            by restricing the counterfactual symbols.
-      # TODO: perhaps a better way to structure this code is to completely get
-      #       rid of interventional symbols when calling genSATExp.py with MACE.
       if 'mace' in approach_string:
         actionability_mutability_plausibility.append(EqualsOrIff(
           model_symbols['counterfactual'][attr_name_kurz]['symbol'],
@@ -491,14 +1084,10 @@ def getPlausibilityFormula(model_symbols, dataset_obj, factual_sample, approach_
     # c) immutable and non-actionable: neither interventional nor counterfactual value can change
     else:
 
-      actionability_mutability_plausibility.append(EqualsOrIff(
-        model_symbols['counterfactual'][attr_name_kurz]['symbol'],
-        factual_sample[attr_name_kurz]
-      ))
-      actionability_mutability_plausibility.append(EqualsOrIff(
-        model_symbols['interventional'][attr_name_kurz]['symbol'],
-        factual_sample[attr_name_kurz]
-      ))
+      actionability_mutability_plausibility.extend([
+        EqualsOrIff(model_symbols[symbol_type][attr_name_kurz]['symbol'], factual_sample[attr_name_kurz])
+        for symbol_type in getInputSymbolTypes(model_symbols)
+      ])
 
   actionability_mutability_plausibility = And(actionability_mutability_plausibility)
 
@@ -513,9 +1102,7 @@ def getPlausibilityFormula(model_symbols, dataset_obj, factual_sample, approach_
 
 
   return And(
-    range_plausibility,
-    onehot_categorical_plausibility,
-    onehot_ordinal_plausibility,
+    factual_independent_plausibility,
     actionability_mutability_plausibility,
     causal_consistency
   )
@@ -533,197 +1120,848 @@ def getDiversityFormulaUpdate(model):
   )
 
 
-def findClosestCounterfactualSample(model_trained, model_symbols, dataset_obj, factual_sample, norm_type, approach_string, epsilon, log_file, min_diff=0, outcome=None):
+def getCenterNormThresholdInRange(lower_bound, upper_bound):
+  return (lower_bound + upper_bound) / 2
 
-  def getCenterNormThresholdInRange(lower_bound, upper_bound):
-    return (lower_bound + upper_bound) / 2
 
-  def assertPrediction(dict_sample, model_trained, dataset_obj):
-    vectorized_sample = []
-    for attr_name_kurz in dataset_obj.getInputAttributeNames('kurz'):
-      vectorized_sample.append(dict_sample[attr_name_kurz])
+def assertPrediction(dict_sample, factual_sample, model_trained, dataset_obj):
+  vectorized_sample = []
+  for attr_name_kurz in dataset_obj.getInputAttributeNames('kurz'):
+    vectorized_sample.append(dict_sample[attr_name_kurz])
 
-    if dataset_obj.problem_type == 'classification':
-      sklearn_prediction = int(model_trained.predict([vectorized_sample])[0])
-      pysmt_prediction = int(dict_sample['y'])
-      factual_prediction = int(factual_sample['y'])
+  if dataset_obj.problem_type == 'classification':
+    sklearn_prediction = int(model_trained.predict([vectorized_sample])[0])
+    pysmt_prediction = int(dict_sample['y'])
+    factual_prediction = int(factual_sample['y'])
+  else:
+    sklearn_prediction = round(float(model_trained.predict([vectorized_sample])[0]), 4)
+    pysmt_prediction = round(float(dict_sample['y']), 4)
+    factual_prediction = float(factual_sample['y'])
+
+  # IMPORTANT: sometimes, MACE does such a good job, that the counterfactual
+  #            ends up super close to (if not on) the decision boundary; here
+  #            the label is underfined which causes inconsistency errors
+  #            between pysmt and sklearn. We skip the assert at such points.
+  if dataset_obj.problem_type == 'classification':
+    class_predict_proba = model_trained.predict_proba([vectorized_sample])[0]
+    sorted_proba = np.sort(class_predict_proba)[::-1]
+    if np.abs(sorted_proba[0] - sorted_proba[1]) < 1e-10:
+      return
+
+  print("Counterfactual:", dict_sample, "\nFactual:", factual_sample)
+  if pysmt_prediction != sklearn_prediction:
+    print('Pysmt prediction does not match sklearn prediction.')
+  elif sklearn_prediction == factual_prediction:
+    print('Counterfactual and factual samples have the same prediction.')
+  else:
+    return True
+  #assert sklearn_prediction == pysmt_prediction, 'Pysmt prediction does not match sklearn prediction.'
+  #assert sklearn_prediction != factual_prediction, 'Counterfactual and factual samples have the same prediction.'
+
+
+# IMPORTANT: the options of the search for the closest counterfactual are
+#            passed around as one dictionary (see getSearchOptions), from
+#            batchTest through genExp down to findClosestCounterfactualSample.
+DEFAULT_SEARCH_OPTIONS = {
+  'min_diff': 0, # for regression, see getRegressionCounterfactualFormula
+  'outcome': None, # the desired label (or output) of the counterfactual
+  'incremental': True, # keep the base formula asserted across solver queries
+  'solver_names': ('z3',), # more than one races a portfolio of backends
+  'num_workers': 1, # more than one tests several thresholds concurrently
+  'bisection_arity': None, # thresholds tested per round (defaults to num_workers)
+  'cache_formulas': True, # reuse model and plausibility formulas across samples
+  'warm_start_samples': None, # candidate counterfactuals tried first (MACE only)
+  'shared_search_state': None, # solver and samples shared by several norms
+  'num_counterfactuals': 1, # more than one also searches for diverse ones
+  'diversity_distance': 0.01, # minimum distance between diverse ones (except zero_norm)
+  'iteration_timeout': None, # seconds per solver query
+  'time_budget': None, # seconds for the whole search
+  'exact_zero_norm': True, # bisect the number of changed attributes
+  'linear_distance': False, # see getLinearDistanceExpression
+  'prune_model': True, # see getSpecializedModelFormula
+  'tree_encoding': None, # see modelConversion.TREE_ENCODINGS (defaults by depth)
+}
+
+
+def getSearchOptions(**search_options):
+  unknown_option_names = set(search_options.keys()) - set(DEFAULT_SEARCH_OPTIONS.keys())
+  if len(unknown_option_names) > 0:
+    raise Exception(f'{sorted(unknown_option_names)} not recognized as search options; expected some of {list(DEFAULT_SEARCH_OPTIONS.keys())}.')
+  search_options = dict(DEFAULT_SEARCH_OPTIONS, **search_options)
+  if search_options['tree_encoding'] is not None and search_options['tree_encoding'] not in TREE_ENCODINGS:
+    raise Exception(f'{search_options["tree_encoding"]} not recognized as a valid `tree_encoding`.')
+  if search_options['bisection_arity'] is None:
+    search_options['bisection_arity'] = search_options['num_workers']
+  return search_options
+
+
+class CounterfactualSearch(object):
+
+  # The state shared by the ways of searching for the closest counterfactual
+  # of one factual sample (see findClosestCounterfactualSample): its formulas,
+  # the norm bounds, the counterfactuals found so far, and the statistics.
+
+  def __init__(self, model_trained, model_symbols, dataset_obj, factual_sample, norm_type, approach_string, epsilon, log_file, search_options):
+    self.model_trained = model_trained
+    self.model_symbols = model_symbols
+    self.dataset_obj = dataset_obj
+    self.factual_sample = factual_sample
+    self.norm_type = norm_type
+    self.approach_string = approach_string
+    self.epsilon = epsilon
+    self.log_file = log_file
+    self.options = search_options
+    self.solver_names = search_options['solver_names']
+
+    # IMPORTANT: with a time budget (in seconds, for this sample, including the
+    #            construction of formulas), the search stops when the budget is
+    #            spent and returns the best counterfactual found so far, along
+    #            with the norm bounds that bracket the minimum distance. Each
+    #            solver query is also limited to iteration_timeout seconds.
+    time_budget = search_options['time_budget']
+    self.search_deadline = time.time() + time_budget if time_budget is not None else None
+
+    # Convert to pysmt_sample so factual symbols can be used in formulae
+    self.factual_pysmt_sample = getPySMTSampleFromDictSample(factual_sample, dataset_obj)
+
+    self.norm_lower_bound = 0
+    self.norm_upper_bound = 1
+
+    if 'mace' in approach_string:
+      self.sample_key, self.distance_key = 'counterfactual_sample', 'counterfactual_distance'
+    elif 'mint' in approach_string:
+      self.sample_key, self.distance_key = 'interventional_sample', 'interventional_distance'
+
+    self.constructFormulas()
+
+    # counterfactuals of trees and forests are rounded, but only where this
+    # keeps them on the same side of each split (see getDictSampleFromPySMTSample)
+    if isinstance(model_trained, (DecisionTreeClassifier, DecisionTreeRegressor, RandomForestClassifier, RandomForestRegressor)):
+      self.split_thresholds = getSplitThresholds(model_trained, model_symbols)
     else:
-      sklearn_prediction = round(float(model_trained.predict([vectorized_sample])[0]), 4)
-      pysmt_prediction = round(float(dict_sample['y']), 4)
-      factual_prediction = float(factual_sample['y'])
-
-    # IMPORTANT: sometimes, MACE does such a good job, that the counterfactual
-    #            ends up super close to (if not on) the decision boundary; here
-    #            the label is underfined which causes inconsistency errors
-    #            between pysmt and sklearn. We skip the assert at such points.
+      self.split_thresholds = None
+
+    # IMPORTANT: when searching for several norms in a row (see
+    #            genExpForAllNorms), the base formula is the very same FNode for
+    #            each norm (pysmt hash-conses formulas), so one incremental
+    #            solver holding it can be shared, and everything z3 learned
+    #            about the model and plausibility constraints is kept.
+    # the search for further (diverse) counterfactuals continues on the same
+    # solver as the search for the closest one
+    self.shared_search_state = search_options['shared_search_state']
+    self.owns_shared_search_state = self.shared_search_state is None and search_options['num_counterfactuals'] > 1
+    if self.owns_shared_search_state:
+      self.shared_search_state = {}
+
+    # In case no counterfactuals are found (this could happen for a variety of
+    # reasons, perhaps due to non-plausibility), return a template counterfactual
+    self.counterfactuals = [{
+      'counterfactual_sample': {},
+      'counterfactual_distance': np.infty,
+      'interventional_sample': {},
+      'interventional_distance': np.infty,
+      'time': np.infty,
+      'norm_type': norm_type}]
+
+    # status is one of 'complete' (search finished), 'unknown' (the solver
+    # returned neither SAT nor UNSAT), 'halted' (a solution failed verification
+    # against the sklearn model), or 'timeout' (the time budget was spent); the
+    # norm bounds bracket the minimum distance.
+    self.search_stats = {
+      'status': 'complete',
+      'iterations': 0,
+      'solver_time': 0,
+      'norm_lower_bound': self.norm_lower_bound,
+      'norm_upper_bound': self.norm_upper_bound,
+      'solver_wins': {}, # solver name --> number of queries it answered first
+      'warm_start_distance': None,
+      'diverse_counterfactuals': [],
+    }
+
+    # tangent cuts that refine the linear relaxation of two_norm; they hold for
+    # any threshold, so they are kept for the rest of the search
+    self.tangent_cuts = []
+    self.max_refinements = 50
+
+  def constructFormulas(self):
+    model_symbols = self.model_symbols
+    dataset_obj = self.dataset_obj
+    factual_pysmt_sample = self.factual_pysmt_sample
+    norm_type = self.norm_type
+    approach_string = self.approach_string
+    log_file = self.log_file
+
+    # Get and merge all constraints
+    print('Constructing initial formulas: model, counterfactual, distance, plausibility, diversity\t\t', end = '', file = log_file)
+    # IMPORTANT: the inputs that the counterfactuals of this factual sample
+    #            cannot change (or can only change in one direction, see
+    #            getCounterfactualInputBounds) are folded into a sample-specific
+    #            model formula (see getSpecializedModelFormula), which is shared
+    #            by all samples with the same signature. Without any such
+    #            constraint, the (cached) full formula is used.
+    feature_domains = {}
+    if self.options['prune_model']:
+      for attr_name_kurz, input_bounds in getCounterfactualInputBounds(model_symbols, dataset_obj, factual_pysmt_sample, approach_string).items():
+        attr_symbols = model_symbols['counterfactual'][attr_name_kurz]
+        if input_bounds != (float(attr_symbols['lower_bound'].constant_value()), float(attr_symbols['upper_bound'].constant_value())):
+          feature_domains[attr_name_kurz] = input_bounds
+    model_formula = getSpecializedModelFormula(model_symbols, self.model_trained, dataset_obj, factual_pysmt_sample, feature_domains, log_file, self.options['cache_formulas'], self.options['tree_encoding'])
+    if self.options['cache_formulas']:
+      factual_independent_plausibility = getCachedFactualIndependentPlausibilityFormula(model_symbols, dataset_obj)
+    else:
+      factual_independent_plausibility = None
     if dataset_obj.problem_type == 'classification':
-      class_predict_proba = model_trained.predict_proba([vectorized_sample])[0]
-      sorted_proba = np.sort(class_predict_proba)[::-1]
-      if np.abs(sorted_proba[0] - sorted_proba[1]) < 1e-10:
-        return
-
-    print("Counterfactual:", dict_sample, "\nFactual:", factual_sample)
-    if pysmt_prediction != sklearn_prediction:
-      print('Pysmt prediction does not match sklearn prediction.')
-    elif sklearn_prediction == factual_prediction:
-      print('Counterfactual and factual samples have the same prediction.')
+      counterfactual_formula = getClassificationCounterfactualFormula(model_symbols, factual_pysmt_sample, outcome=self.options['outcome'])
+    elif dataset_obj.problem_type == 'regression':
+      counterfactual_formula = getRegressionCounterfactualFormula(model_symbols, factual_pysmt_sample, min_diff=self.options['min_diff'], outcome=self.options['outcome'])
+    plausibility_formula = getPlausibilityFormula(model_symbols, dataset_obj, factual_pysmt_sample, approach_string, factual_independent_plausibility)
+    model_phase_formula = getModelPhaseFormula(model_symbols, self.model_trained, dataset_obj, factual_pysmt_sample, approach_string)
+    linear_distance = self.options['linear_distance']
+    self.squared_differences = None # for the linear relaxation of two_norm only
+    # IMPORTANT: z3's optimizer is 10-50x slower on Ite-based absolute values
+    #            than on the linear encoding, whose minimum is the same, so
+    #            `opt` always minimizes the linear one_norm and infty_norm.
+    if (linear_distance or 'opt' in approach_string) and norm_type in {'one_norm', 'infty_norm'}:
+      self.distance_expression, self.distance_constraints = getLinearDistanceExpression(model_symbols, dataset_obj, factual_pysmt_sample, norm_type, approach_string)
+    elif linear_distance and norm_type == 'two_norm' and len(self.solver_names) == 1 and self.options['num_workers'] == 1:
+      self.distance_expression, self.distance_constraints, self.squared_differences = getLinearSquaredDistanceExpression(model_symbols, dataset_obj, factual_pysmt_sample, approach_string)
     else:
-      return True
-    #assert sklearn_prediction == pysmt_prediction, 'Pysmt prediction does not match sklearn prediction.'
-    #assert sklearn_prediction != factual_prediction, 'Counterfactual and factual samples have the same prediction.'
-
-  # Convert to pysmt_sample so factual symbols can be used in formulae
-  factual_pysmt_sample = getPySMTSampleFromDictSample(factual_sample, dataset_obj)
-
-  norm_lower_bound = 0
-  norm_upper_bound = 1
-  curr_norm_threshold = getCenterNormThresholdInRange(norm_lower_bound, norm_upper_bound)
-
-  # Get and merge all constraints
-  print('Constructing initial formulas: model, counterfactual, distance, plausibility, diversity\t\t', end = '', file = log_file)
-  model_formula = getModelFormula(model_symbols, model_trained)
-  if dataset_obj.problem_type == 'classification':
-    counterfactual_formula = getClassificationCounterfactualFormula(model_symbols, factual_pysmt_sample, outcome=outcome)
-  elif dataset_obj.problem_type == 'regression':
-    counterfactual_formula = getRegressionCounterfactualFormula(model_symbols, factual_pysmt_sample, min_diff=min_diff, outcome=outcome)
-  plausibility_formula = getPlausibilityFormula(model_symbols, dataset_obj, factual_pysmt_sample, approach_string)
-  distance_formula = getDistanceFormula(model_symbols, dataset_obj, factual_pysmt_sample, norm_type, approach_string, curr_norm_threshold)
-  diversity_formula = TRUE() # simply initialize and modify later as new counterfactuals come in
-  print('done.', file = log_file)
-
-  iters = 1
-  max_iters = 100
-  counterfactuals = [] # list of tuples (samples, distances)
-  # In case no counterfactuals are found (this could happen for a variety of
-  # reasons, perhaps due to non-plausibility), return a template counterfactual
-  counterfactuals.append({
-    'counterfactual_sample': {},
-    'counterfactual_distance': np.infty,
-    'interventional_sample': {},
-    'interventional_distance': np.infty,
-    'time': np.infty,
-    'norm_type': norm_type})
-
-  print('Solving (not searching) for closest counterfactual using various distance thresholds...', file = log_file)
-
-  while iters < max_iters and norm_upper_bound - norm_lower_bound >= epsilon:
-
-    print(f'\tIteration #{iters:03d}: testing norm threshold {curr_norm_threshold:.6f} in range [{norm_lower_bound:.6f}, {norm_upper_bound:.6f}]...\t', end = '', file = log_file)
-    iters = iters + 1
-
-    formula = And( # works for both initial iteration and all subsequent iterations
+      if linear_distance and norm_type == 'two_norm':
+        print('[WARNING: the linear relaxation of two_norm needs a single solver and worker; using the non-linear distance instead]\t', end = '', file = log_file)
+      self.distance_expression, self.distance_constraints = getDistanceExpression(model_symbols, dataset_obj, factual_pysmt_sample, norm_type, approach_string), TRUE()
+    diversity_formula = TRUE() # simply initialize and modify later as new counterfactuals come in
+    print('done.', file = log_file)
+
+    # The model, counterfactual, plausibility, and diversity formulas do not
+    # depend on the norm threshold; only the distance formula changes between
+    # iterations of the binary search below. The constraints of a linearized
+    # distance expression (if any) are asserted along with each distance
+    # formula, so that the base formula remains the same across norms.
+    self.base_formula = And(
       model_formula,
+      model_phase_formula,
       counterfactual_formula,
       plausibility_formula,
-      distance_formula,
       diversity_formula,
     )
 
-    solver_name = "z3"
-    with Solver(name=solver_name) as solver:
-      solver.add_assertion(formula)
-
+  def getQueryTimeout(self):
+    # seconds that the next solver query may take (None for no limit)
+    query_timeouts = []
+    if self.options['iteration_timeout'] is not None:
+      query_timeouts.append(self.options['iteration_timeout'])
+    if self.search_deadline is not None:
+      query_timeouts.append(max(self.search_deadline - time.time(), 0.001))
+    return min(query_timeouts) if len(query_timeouts) > 0 else None
+
+  def isOutOfTime(self):
+    return self.search_deadline is not None and time.time() >= self.search_deadline
+
+  def getIncrementalSolver(self):
+    # returns the solver, and whether it is owned (to be closed) by the caller
+    shared_search_state = self.shared_search_state
+    if shared_search_state is None:
+      solver = Solver(name=self.solver_names[0])
+      solver.add_assertion(self.base_formula)
+      return solver, True
+    if shared_search_state.get('base_formula') is not self.base_formula:
+      if shared_search_state.get('solver') is not None:
+        shared_search_state['solver'].exit()
+      shared_search_state['solver'] = Solver(name=self.solver_names[0])
+      shared_search_state['solver'].add_assertion(self.base_formula)
+      shared_search_state['base_formula'] = self.base_formula
+    return shared_search_state['solver'], False
+
+  def countSolverCall(self, solve_time, solver_name=None):
+    self.search_stats['iterations'] += 1
+    self.search_stats['solver_time'] += solve_time
+    if solver_name is not None:
+      self.search_stats['solver_wins'][solver_name] = self.search_stats['solver_wins'].get(solver_name, 0) + 1
+
+  def getVerifiedCounterfactual(self, model, solve_time):
+    model_symbols = self.model_symbols
+    dataset_obj = self.dataset_obj
+    counterfactual_pysmt_sample = {}
+    interventional_pysmt_sample = {}
+    for (symbol_key, symbol_value) in model:
+      # symbol_key may be 'x#', {'p0#', 'p1#'}, 'w#', or 'y'
+      tmp = str(symbol_key)
+      if 'counterfactual' in str(symbol_key):
+        tmp = tmp[:-15]
+        if tmp in dataset_obj.getInputOutputAttributeNames('kurz'):
+          counterfactual_pysmt_sample[tmp] = symbol_value
+      elif 'interventional' in str(symbol_key):
+        tmp = tmp[:-15]
+        if tmp in dataset_obj.getInputOutputAttributeNames('kurz'):
+          interventional_pysmt_sample[tmp] = symbol_value
+      elif tmp in dataset_obj.getInputOutputAttributeNames('kurz'): # for y variable
+        counterfactual_pysmt_sample[tmp] = symbol_value
+        interventional_pysmt_sample[tmp] = symbol_value
+    # in the compact encoding, some inputs are terms over the compact symbols
+    counterfactual_pysmt_sample.update(getDerivedInputValues(model_symbols, 'counterfactual', model))
+    interventional_pysmt_sample.update(getDerivedInputValues(model_symbols, 'interventional', model))
+
+    # Convert back from pysmt_sample to dict_sample to compute distance and save
+    model_trained = self.model_trained
+    counterfactual_sample = getDictSampleFromPySMTSample(
+      counterfactual_pysmt_sample,
+      dataset_obj, round=self.split_thresholds is not None, split_thresholds=self.split_thresholds)
+    if len(model_symbols['interventional']) > 0:
+      interventional_sample  = getDictSampleFromPySMTSample(
+        interventional_pysmt_sample,
+        dataset_obj)
+    else: # MACE, where the counterfactual itself is the action (see genExp)
+      interventional_sample = counterfactual_sample
+
+    # Assert samples have correct prediction label according to sklearn model
+    cf_valid = assertPrediction(counterfactual_sample, self.factual_sample, model_trained, dataset_obj)
+    # of course, there is no need to assertPrediction on the interventional_sample
+
+    if not cf_valid:
+      return None
+
+    counterfactual_distance = normalizedDistance.getDistanceBetweenSamples(
+      self.factual_sample,
+      counterfactual_sample,
+      self.norm_type,
+      dataset_obj)
+    interventional_distance = normalizedDistance.getDistanceBetweenSamples(
+      self.factual_sample,
+      interventional_sample,
+      self.norm_type,
+      dataset_obj)
+    return {
+      'counterfactual_sample': counterfactual_sample,
+      'counterfactual_distance': counterfactual_distance,
+      'interventional_sample': interventional_sample,
+      'interventional_distance': interventional_distance,
+      'time': solve_time,
+      'norm_type': self.norm_type}
+
+  def solveDistanceThreshold(self, solver, norm_threshold, reset_base=False):
+    # IMPORTANT: the solver's own three-valued status is all we need: SAT
+    #            tightens the upper bound, UNSAT moves the lower bound, and
+    #            UNKNOWN (e.g., due to non-linear arithmetic or a timeout)
+    #            leaves the search incomplete. With the linear relaxation of
+    #            two_norm, a SAT solution whose exact distance exceeds the
+    #            threshold is cut off by the tangents at the solution (of the
+    #            squares it underestimates), and the same threshold is tested
+    #            again (counted as further solver calls).
+    solve_time = 0
+    for refinement in range(self.max_refinements):
+      if reset_base:
+        solver.reset_assertions()
+        solver.add_assertion(self.base_formula)
+      solver.push()
+      solver.add_assertion(And(
+        self.distance_constraints,
+        And(self.tangent_cuts),
+        getModelPhaseFormula(self.model_symbols, self.model_trained, self.dataset_obj, self.factual_pysmt_sample, self.approach_string, self.norm_type, norm_threshold),
+        getDistanceThresholdFormula(self.distance_expression, self.norm_type, norm_threshold)
+      ))
+      setSolverTimeout(solver, self.getQueryTimeout())
       iteration_start_time = time.time()
-      solved = solver.solve()
+      try:
+        solver_result = 'sat' if solver.solve() else 'unsat'
+      except SolverReturnedUnknownResultError:
+        solver_result = 'unknown'
       iteration_end_time = time.time()
+      solve_time += iteration_end_time - iteration_start_time
+      model = solver.get_model() if solver_result == 'sat' else None
+      solver.pop()
+
+      if solver_result != 'sat' or self.squared_differences is None:
+        return solver_result, model, solve_time
+      # the tolerance covers the rounding of the tangent points (see
+      # getSquaredDistanceTangentCuts), which may not cut off such solutions
+      if getSquaredDistanceValue(model, self.distance_expression, self.squared_differences) <= norm_threshold ** 2 * (1 + 1e-9):
+        return solver_result, model, solve_time
+      self.tangent_cuts.extend(getSquaredDistanceTangentCuts(model, self.squared_differences))
+      self.search_stats['iterations'] += 1
+    return 'unknown', None, solve_time
+
+  def warmStart(self):
+    # IMPORTANT: most minimum distances are far below the initial upper bound of
+    #            1, so the first bisection iterations (0.5, 0.25, ...) are mostly
+    #            wasted. Cheap candidate counterfactuals (e.g., the closest
+    #            observable sample, or counterfactuals of other factual samples)
+    #            are therefore tried first, closest first. A candidate is only
+    #            used if it satisfies the full formula (model, counterfactual,
+    #            plausibility) and if the sklearn model agrees with its label;
+    #            it then becomes the first counterfactual and the upper bound.
+    warm_start_samples = self.options['warm_start_samples']
+    if warm_start_samples is None or 'mace' not in self.approach_string or 'opt' in self.approach_string:
+      return
+
+    print('Verifying warm start candidates...\t', end = '', file = self.log_file)
+    warm_start_candidates = sorted([
+      (normalizedDistance.getDistanceBetweenSamples(self.factual_sample, warm_start_sample, self.norm_type, self.dataset_obj), warm_start_sample)
+      for warm_start_sample in warm_start_samples
+      if len(warm_start_sample.keys()) > 0
+    ], key = lambda candidate: candidate[0])
+
+    warm_start_solver, owns_warm_start_solver = self.getIncrementalSolver()
+    try:
+      for warm_start_distance, warm_start_sample in warm_start_candidates:
+        if warm_start_distance >= self.norm_upper_bound or self.isOutOfTime():
+          break
+        warm_start_pysmt_sample = getPySMTSampleFromDictSample(warm_start_sample, self.dataset_obj)
+        warm_start_solver.push()
+        warm_start_solver.add_assertion(And([
+          EqualsOrIff(self.model_symbols['counterfactual'][attr_name_kurz]['symbol'], warm_start_pysmt_sample[attr_name_kurz])
+          for attr_name_kurz in self.dataset_obj.getInputAttributeNames('kurz')
+        ]))
+        setSolverTimeout(warm_start_solver, self.getQueryTimeout())
+        iteration_start_time = time.time()
+        try:
+          warm_start_result = warm_start_solver.solve()
+        except SolverReturnedUnknownResultError:
+          warm_start_result = False
+        iteration_end_time = time.time()
+        self.countSolverCall(iteration_end_time - iteration_start_time)
+        counterfactual = self.getVerifiedCounterfactual(warm_start_solver.get_model(), iteration_end_time - iteration_start_time) if warm_start_result else None
+        warm_start_solver.pop()
+        if counterfactual is not None:
+          self.counterfactuals.append(counterfactual)
+          self.norm_upper_bound = float(counterfactual['counterfactual_distance'] + self.epsilon / 100) # not float64
+          self.search_stats['warm_start_distance'] = counterfactual['counterfactual_distance']
+          self.search_stats['norm_upper_bound'] = self.norm_upper_bound
+          break
+    finally:
+      if owns_warm_start_solver:
+        warm_start_solver.exit()
 
-      if solved: # joint formula is satisfiable
-        model = solver.get_model()
-        print('solution exists & found.', file = log_file)
-        counterfactual_pysmt_sample = {}
-        interventional_pysmt_sample = {}
-        for (symbol_key, symbol_value) in model:
-          # symbol_key may be 'x#', {'p0#', 'p1#'}, 'w#', or 'y'
-          tmp = str(symbol_key)
-          if 'counterfactual' in str(symbol_key):
-            tmp = tmp[:-15]
-            if tmp in dataset_obj.getInputOutputAttributeNames('kurz'):
-              counterfactual_pysmt_sample[tmp] = symbol_value
-          elif 'interventional' in str(symbol_key):
-            tmp = tmp[:-15]
-            if tmp in dataset_obj.getInputOutputAttributeNames('kurz'):
-              interventional_pysmt_sample[tmp] = symbol_value
-          elif tmp in dataset_obj.getInputOutputAttributeNames('kurz'): # for y variable
-            counterfactual_pysmt_sample[tmp] = symbol_value
-            interventional_pysmt_sample[tmp] = symbol_value
-
-        # Convert back from pysmt_sample to dict_sample to compute distance and save
-        round_flag = isinstance(model_trained, RandomForestClassifier) or isinstance(model_trained, RandomForestRegressor)\
-                     or isinstance(model_trained, DecisionTreeClassifier) or isinstance(model_trained, DecisionTreeRegressor)
-        counterfactual_sample = getDictSampleFromPySMTSample(
-          counterfactual_pysmt_sample,
-          dataset_obj, round=round_flag)
-        interventional_sample  = getDictSampleFromPySMTSample(
-          interventional_pysmt_sample,
-          dataset_obj)
-
-        # Assert samples have correct prediction label according to sklearn model
-        cf_valid = assertPrediction(counterfactual_sample, model_trained, dataset_obj)
-        # of course, there is no need to assertPrediction on the interventional_sample
-
-        if cf_valid:
-          counterfactual_distance = normalizedDistance.getDistanceBetweenSamples(
-            factual_sample,
-            counterfactual_sample,
-            norm_type,
-            dataset_obj)
-          interventional_distance = normalizedDistance.getDistanceBetweenSamples(
-            factual_sample,
-            interventional_sample,
-            norm_type,
-            dataset_obj)
-          counterfactual_time = iteration_end_time - iteration_start_time
-          counterfactuals.append({
-            'counterfactual_sample': counterfactual_sample,
-            'counterfactual_distance': counterfactual_distance,
-            'interventional_sample': interventional_sample,
-            'interventional_distance': interventional_distance,
-            'time': counterfactual_time,
-            'norm_type': norm_type})
-
-          # Update diversity and distance formulas now that we have found a solution
-          # TODO: I think the line below should be removed, because in successive
-          #       reductions of delta, we should be able to re-use previous CFs
-          # diversity_formula = And(diversity_formula, getDiversityFormulaUpdate(model))
-
-          # IMPORTANT: something odd happens somtimes if use vanilla binary search;
-          #            On the first iteration, with [0, 1] bounds, we may see a CF at
-          #            d = 0.22. When we update the bounds to [0, 0.5] bounds,  we
-          #            sometimes surprisingly see a new CF at distance 0.24. We optimize
-          #            the binary search to solve this.
-          norm_lower_bound = norm_lower_bound
-          # norm_upper_bound = curr_norm_threshold
-          if 'mace' in approach_string:
-            norm_upper_bound = float(counterfactual_distance + epsilon / 100) # not float64
-          elif 'mint' in approach_string:
-            norm_upper_bound = float(interventional_distance + epsilon / 100) # not float64
-          curr_norm_threshold = getCenterNormThresholdInRange(norm_lower_bound, norm_upper_bound)
-          distance_formula = getDistanceFormula(model_symbols, dataset_obj, factual_pysmt_sample, norm_type, approach_string, curr_norm_threshold)
+    if self.search_stats['warm_start_distance'] is not None:
+      print(f'starting search at upper bound {self.norm_upper_bound:.6f}.', file = self.log_file)
+    else:
+      print(f'none of {len(warm_start_candidates)} candidates is a valid counterfactual.', file = self.log_file)
+
+  def searchByOptimization(self):
+    # IMPORTANT: instead of ~log2(1/epsilon) satisfiability checks, the distance
+    #            expression is minimized directly with z3's optimizing solver.
+    #            This is exact (not epsilon-approximate), but only applies when
+    #            the objective is linear, i.e., not for two_norm.
+    norm_type = self.norm_type
+    log_file = self.log_file
+    if norm_type == 'two_norm':
+      raise Exception(f'{norm_type} is non-linear and cannot be minimized directly; use `eps` instead of `opt`.')
+    if norm_type == 'zero_norm':
+      print(f'[WARNING] {norm_type} has no linear encoding; minimizing its Ite-based expression may be much slower than `eps`.', file = log_file)
+
+    print('Solving for closest counterfactual by minimizing the distance expression...\t', end = '', file = log_file)
+    converter = Z3Converter(get_env(), z3.main_ctx())
+    optimizer = z3.Optimize()
+    optimizer.add(converter.convert(And(self.base_formula, self.distance_constraints)))
+    optimizer.minimize(converter.convert(self.distance_expression))
+    if self.getQueryTimeout() is not None:
+      optimizer.set('timeout', max(int(self.getQueryTimeout() * 1000), 1))
+
+    iteration_start_time = time.time()
+    optimizer_result = optimizer.check()
+    iteration_end_time = time.time()
+
+    self.search_stats['iterations'] = 1
+    self.search_stats['solver_time'] = iteration_end_time - iteration_start_time
+    self.search_stats['solver_wins'] = {'z3': 1}
+
+    if optimizer_result == z3.sat:
+      model = Z3Model(get_env(), optimizer.model())
+      optimal_distance = float(model.get_value(self.distance_expression).constant_value())
+      print(f'optimal distance {optimal_distance:.6f} found.', file = log_file)
+      self.search_stats['norm_lower_bound'] = optimal_distance
+      self.search_stats['norm_upper_bound'] = optimal_distance
+      counterfactual = self.getVerifiedCounterfactual(model, iteration_end_time - iteration_start_time)
+      if counterfactual is not None:
+        self.counterfactuals.append(counterfactual)
+      else:
+        print('Halting search here.')
+        self.search_stats['status'] = 'halted'
+    elif optimizer_result == z3.unsat:
+      print('no solution exists.', file = log_file)
+    else:
+      print('no solution found (SMT issue or timeout).', file = log_file)
+      self.search_stats['status'] = 'timeout' if self.isOutOfTime() else 'unknown'
+
+  def searchWithSolverPool(self):
+    bisection_arity = self.options['bisection_arity']
+    num_workers = self.options['num_workers']
+    norm_type = self.norm_type
+    log_file = self.log_file
+    search_stats = self.search_stats
+    print(f'Solving for closest counterfactual by testing {bisection_arity} distance thresholds at a time on {num_workers} workers...', file = log_file)
+
+    # IMPORTANT: instead of testing only the midpoint of [lower, upper], each
+    #            round tests k evenly spaced thresholds concurrently. A SAT
+    #            answer at one threshold makes all larger thresholds irrelevant,
+    #            and an UNSAT answer makes all smaller thresholds irrelevant;
+    #            such queries are cancelled as soon as a faster result arrives.
+    #            Each round shrinks the interval by a factor of ~(k + 1).
+    distance_symbol = Symbol('distance', REAL)
+    pool = SolverPool(self.solver_names, And(self.base_formula, self.distance_constraints, Equals(distance_symbol, self.distance_expression)), num_workers)
+
+    iters = 1
+    max_iters = 100
+    norm_lower_bound, norm_upper_bound = self.norm_lower_bound, self.norm_upper_bound
+    try:
+
+      while iters < max_iters and norm_upper_bound - norm_lower_bound >= self.epsilon and search_stats['status'] == 'complete':
+
+        if self.isOutOfTime():
+          search_stats['status'] = 'timeout'
+          break
+
+        norm_thresholds = [
+          norm_lower_bound + (threshold_idx + 1) * (norm_upper_bound - norm_lower_bound) / (bisection_arity + 1)
+          for threshold_idx in range(bisection_arity)
+        ]
+        print(f'\tRound #{iters:03d}: testing norm thresholds {[round(t, 6) for t in norm_thresholds]} in range [{norm_lower_bound:.6f}, {norm_upper_bound:.6f}]...', file = log_file)
+        iters = iters + 1
+        round_bounds = (norm_lower_bound, norm_upper_bound)
+
+        for norm_threshold in norm_thresholds:
+          pool.submit(getDistanceThresholdFormula(distance_symbol, norm_type, norm_threshold), norm_threshold, self.getQueryTimeout())
+
+        while pool.hasPending():
+
+          try:
+            pool_answer = pool.receive(None if self.search_deadline is None else max(self.search_deadline - time.time(), 0))
+          except SolverWorkersFailedError as e:
+            # e.g., every backend fails on the formula; the sample is given up
+            # on, as for a timeout, instead of aborting the whole batch
+            print(f'\t\t{e} Halting search here.', file = log_file)
+            search_stats['status'] = 'halted'
+            break
+          if pool_answer is None:
+            print('\t\ttime budget spent.', file = log_file)
+            search_stats['status'] = 'timeout'
+            break
+          norm_threshold, solver_result, model, solve_time, solver_name = pool_answer
+          self.countSolverCall(solve_time, solver_name)
+
+          if solver_result == 'sat':
+            print(f'\t\tnorm threshold {norm_threshold:.6f}: solution exists & found ({solver_name}).', file = log_file)
+            counterfactual = self.getVerifiedCounterfactual(model, solve_time)
+            if counterfactual is None:
+              print('Halting search here.')
+              search_stats['status'] = 'halted'
+              break
+            self.counterfactuals.append(counterfactual)
+            norm_upper_bound = min(norm_upper_bound, float(counterfactual[self.distance_key] + self.epsilon / 100)) # not float64
+          elif solver_result == 'unsat':
+            print(f'\t\tnorm threshold {norm_threshold:.6f}: no solution exists ({solver_name}).', file = log_file)
+            norm_lower_bound = max(norm_lower_bound, norm_threshold)
+          else:
+            print(f'\t\tnorm threshold {norm_threshold:.6f}: no solution found (SMT issue).', file = log_file)
+
+          pool.cancel(lambda t: t <= norm_lower_bound or t >= norm_upper_bound)
+
+        if search_stats['status'] == 'complete' and (norm_lower_bound, norm_upper_bound) == round_bounds:
+          # none of the thresholds in this round could be decided
+          search_stats['status'] = 'timeout' if self.isOutOfTime() else 'unknown'
+
+    finally:
+      pool.close()
+
+    search_stats['norm_lower_bound'] = norm_lower_bound
+    search_stats['norm_upper_bound'] = norm_upper_bound
+
+  def searchZeroNorm(self):
+    log_file = self.log_file
+    search_stats = self.search_stats
+    solver_name = self.solver_names[0]
+    print('Solving for closest counterfactual using various numbers of changed attributes...', file = log_file)
+
+    # IMPORTANT: the zero_norm distance is discrete, so instead of bisecting a
+    #            real range down to epsilon, the number k of changed distance
+    #            terms is bisected exactly, i.e., with O(log n) solver calls.
+    #            Throughout, no counterfactual changes `min_changed_count` or
+    #            fewer terms, and one changes `max_changed_count` terms (where
+    #            n + 1 means that none has been found yet).
+    changed_literals, changed_formula = getChangedLiterals(self.model_symbols, self.dataset_obj, self.factual_pysmt_sample, self.approach_string)
+    changed_count = len(changed_literals)
+    min_changed_count = -1
+    max_changed_count = changed_count + 1
+    if search_stats['warm_start_distance'] is not None:
+      max_changed_count = int(round(search_stats['warm_start_distance'] * changed_count))
+
+    solver, owns_solver = self.getIncrementalSolver()
+    solver.push()
+    solver.add_assertion(changed_formula)
+
+    iters = 1
+    try:
+
+      while max_changed_count - min_changed_count > 1:
+
+        if self.isOutOfTime():
+          print('\ttime budget spent.', file = log_file)
+          search_stats['status'] = 'timeout'
+          break
+
+        curr_changed_count = (min_changed_count + max_changed_count) // 2
+        print(f'\tIteration #{iters:03d}: testing at most {curr_changed_count} changed of {changed_count} in range [{min_changed_count + 1}, {max_changed_count}]...\t', end = '', file = log_file)
+        iters = iters + 1
+
+        solver.push()
+        solver.add_assertion(getCardinalityFormula(changed_literals, curr_changed_count))
+        setSolverTimeout(solver, self.getQueryTimeout())
+        iteration_start_time = time.time()
+        try:
+          solver_result = 'sat' if solver.solve() else 'unsat'
+        except SolverReturnedUnknownResultError:
+          solver_result = 'unknown'
+        iteration_end_time = time.time()
+        model = solver.get_model() if solver_result == 'sat' else None
+        solver.pop()
+
+        self.countSolverCall(iteration_end_time - iteration_start_time, solver_name)
+
+        if solver_result == 'sat':
+          print(f'solution exists & found ({solver_name}).', file = log_file)
+          counterfactual = self.getVerifiedCounterfactual(model, iteration_end_time - iteration_start_time)
+          if counterfactual is None:
+            print('Halting search here.')
+            search_stats['status'] = 'halted'
+            break
+          self.counterfactuals.append(counterfactual)
+          max_changed_count = min(curr_changed_count, sum(1 for changed_literal in changed_literals if model.get_py_value(changed_literal)))
+        elif solver_result == 'unsat':
+          print(f'no solution exists ({solver_name}).', file = log_file)
+          min_changed_count = curr_changed_count
         else:
-          print('Halting search here.')
+          print('no solution found (SMT issue or timeout).', file = log_file)
+          search_stats['status'] = 'timeout' if self.isOutOfTime() else 'unknown'
           break
 
-      else: # no solution found in the assigned norm range --> update range and try again
-        with Solver(name=solver_name) as neg_solver:
-          neg_formula = Not(formula)
-          neg_solver.add_assertion(neg_formula)
-          neg_solved = neg_solver.solve()
-          if neg_solved:
-            print('no solution exists.', file = log_file)
-            norm_lower_bound = curr_norm_threshold
-            norm_upper_bound = norm_upper_bound
+    finally:
+      solver.pop()
+      if owns_solver:
+        solver.exit()
+
+    # no counterfactual changes fewer than min_changed_count + 1 terms
+    search_stats['norm_lower_bound'] = min((min_changed_count + 1) / changed_count, 1)
+    search_stats['norm_upper_bound'] = min(max_changed_count / changed_count, 1)
+
+  def searchByBisection(self):
+    solver_names = self.solver_names
+    incremental = self.options['incremental']
+    norm_type = self.norm_type
+    log_file = self.log_file
+    search_stats = self.search_stats
+    print('Solving (not searching) for closest counterfactual using various distance thresholds...', file = log_file)
+
+    # IMPORTANT: in incremental mode, the threshold-independent base formula
+    #            is asserted only once, and the distance formula is swapped in
+    #            and out using push/pop. This way, z3 keeps everything it
+    #            learned about the base formula across iterations. Otherwise,
+    #            the solver is reset and everything is re-asserted.
+    #            With more than one solver name, the same queries are raced on
+    #            a portfolio of backends, each running in its own process. The
+    #            distance expression is then named by a symbol in the base
+    #            formula so that each query only carries the threshold.
+    if len(solver_names) > 1:
+      distance_symbol = Symbol('distance', REAL)
+      portfolio = SolverPortfolio(solver_names, And(self.base_formula, self.distance_constraints, Equals(distance_symbol, self.distance_expression)))
+    elif incremental:
+      solver, owns_solver = self.getIncrementalSolver()
+    else:
+      solver, owns_solver = Solver(name=solver_names[0]), True
+
+    def checkNormThreshold(norm_threshold):
+      if len(solver_names) > 1:
+        return portfolio.solve(getDistanceThresholdFormula(distance_symbol, norm_type, norm_threshold), self.getQueryTimeout())
+
+      solver_result, model, solve_time = self.solveDistanceThreshold(solver, norm_threshold, reset_base = not incremental)
+      return solver_result, model, solve_time, solver_names[0]
+
+    iters = 1
+    max_iters = 100
+    norm_lower_bound, norm_upper_bound = self.norm_lower_bound, self.norm_upper_bound
+    curr_norm_threshold = getCenterNormThresholdInRange(norm_lower_bound, norm_upper_bound)
+    try:
+
+      while iters < max_iters and norm_upper_bound - norm_lower_bound >= self.epsilon:
+
+        if self.isOutOfTime():
+          print('\ttime budget spent.', file = log_file)
+          search_stats['status'] = 'timeout'
+          break
+
+        print(f'\tIteration #{iters:03d}: testing norm threshold {curr_norm_threshold:.6f} in range [{norm_lower_bound:.6f}, {norm_upper_bound:.6f}]...\t', end = '', file = log_file)
+        iters = iters + 1
+
+        solver_result, model, solve_time, solver_name = checkNormThreshold(curr_norm_threshold)
+        self.countSolverCall(solve_time, solver_name)
+
+        if solver_result == 'sat': # joint formula is satisfiable
+          print(f'solution exists & found ({solver_name}).', file = log_file)
+          counterfactual = self.getVerifiedCounterfactual(model, solve_time)
+
+          if counterfactual is not None:
+            self.counterfactuals.append(counterfactual)
+
+            # Update diversity and distance formulas now that we have found a solution
+            # TODO: I think the line below should be removed, because in successive
+            #       reductions of delta, we should be able to re-use previous CFs
+            # diversity_formula = And(diversity_formula, getDiversityFormulaUpdate(model))
+
+            # IMPORTANT: something odd happens somtimes if use vanilla binary search;
+            #            On the first iteration, with [0, 1] bounds, we may see a CF at
+            #            d = 0.22. When we update the bounds to [0, 0.5] bounds,  we
+            #            sometimes surprisingly see a new CF at distance 0.24. We optimize
+            #            the binary search to solve this.
+            norm_lower_bound = norm_lower_bound
+            # norm_upper_bound = curr_norm_threshold
+            norm_upper_bound = float(counterfactual[self.distance_key] + self.epsilon / 100) # not float64
             curr_norm_threshold = getCenterNormThresholdInRange(norm_lower_bound, norm_upper_bound)
-            distance_formula = getDistanceFormula(model_symbols, dataset_obj, factual_pysmt_sample, norm_type, approach_string, curr_norm_threshold)
           else:
-            print('no solution found (SMT issue).', file = log_file)
-            quit()
+            print('Halting search here.')
+            search_stats['status'] = 'halted'
+            break
+
+        elif solver_result == 'unsat': # no solution exists in the assigned norm range --> update range and try again
+          print(f'no solution exists ({solver_name}).', file = log_file)
+          norm_lower_bound = curr_norm_threshold
+          norm_upper_bound = norm_upper_bound
+          curr_norm_threshold = getCenterNormThresholdInRange(norm_lower_bound, norm_upper_bound)
+
+        else: # solver could not decide; return the best counterfactual found so far
+          print('no solution found (SMT issue or timeout).', file = log_file)
+          search_stats['status'] = 'timeout' if self.isOutOfTime() else 'unknown'
+          break
+
+    finally:
+      if len(solver_names) > 1:
+        portfolio.close()
+      elif owns_solver:
+        solver.exit()
+
+    search_stats['norm_lower_bound'] = norm_lower_bound
+    search_stats['norm_upper_bound'] = norm_upper_bound
+
+  def searchDiverseCounterfactuals(self):
+    # IMPORTANT: further counterfactuals are found by blocking every previous
+    #            one on the same live solver, i.e., by requiring the next one to
+    #            be more than diversity_distance away from each of them (in the
+    #            same norm), and searching for the closest counterfactual again.
+    #            For zero_norm, whose distances are multiples of 1 / n, the next
+    #            one must instead change a different set of attributes. The
+    #            blocked space only shrinks, so the lower bound of the previous
+    #            search remains valid for the next one.
+    num_counterfactuals = self.options['num_counterfactuals']
+    diversity_distance = self.options['diversity_distance']
+    epsilon = self.epsilon
+    log_file = self.log_file
+    search_stats = self.search_stats
+    sample_key, distance_key = self.sample_key, self.distance_key
+    if num_counterfactuals <= 1 or len(self.counterfactuals) <= 1 or search_stats['status'] != 'complete':
+      return
+
+    if self.norm_type == 'zero_norm':
+      print(f'Solving for {num_counterfactuals - 1} further counterfactuals, each changing a different set of attributes than the previous ones...', file = log_file)
+    else:
+      print(f'Solving for {num_counterfactuals - 1} further counterfactuals, each more than {diversity_distance} away from the previous ones...', file = log_file)
+    search_stats['diverse_counterfactuals'].append(sorted(self.counterfactuals[1:], key = lambda x: x[distance_key])[0])
+    norm_lower_bound = search_stats['norm_lower_bound']
+    solver, _ = self.getIncrementalSolver()
+    solver.push()
+
+    variable_to_compute_distance_on = 'counterfactual' if 'mace' in self.approach_string else 'interventional'
+    if self.norm_type == 'zero_norm':
+      changed_literals, changed_formula = getChangedLiterals(self.model_symbols, self.dataset_obj, self.factual_pysmt_sample, self.approach_string)
+      solver.add_assertion(changed_formula)
+
+    try:
+
+      while len(search_stats['diverse_counterfactuals']) < num_counterfactuals and not self.isOutOfTime():
+
+        previous_pysmt_sample = getPySMTSampleFromDictSample(search_stats['diverse_counterfactuals'][-1][sample_key], self.dataset_obj)
+        if self.norm_type == 'zero_norm':
+          # the changed literals of the previous one, i.e., a conjunction of
+          # (negated) literals, are blocked
+          previous_changed_literals = changed_formula.substitute({
+            self.model_symbols[variable_to_compute_distance_on][attr_name_kurz]['symbol']: previous_pysmt_sample[attr_name_kurz]
+            for attr_name_kurz in self.dataset_obj.getInputAttributeNames('kurz')
+          }).simplify()
+          solver.add_assertion(Not(previous_changed_literals))
+        else:
+          # the blocking constraint needs the exact (Ite-based) distance
+          solver.add_assertion(Not(getDistanceThresholdFormula(
+            getDistanceExpression(self.model_symbols, self.dataset_obj, previous_pysmt_sample, self.norm_type, self.approach_string),
+            self.norm_type,
+            diversity_distance)))
+
+        next_counterfactual = None
+        norm_upper_bound = 1
+        diverse_start_time = time.time()
+        while norm_upper_bound - norm_lower_bound >= epsilon and not self.isOutOfTime():
+          curr_norm_threshold = getCenterNormThresholdInRange(norm_lower_bound, norm_upper_bound)
+          solver_result, model, solve_time = self.solveDistanceThreshold(solver, curr_norm_threshold)
+          self.countSolverCall(solve_time)
+          counterfactual = self.getVerifiedCounterfactual(model, solve_time) if solver_result == 'sat' else None
+          if solver_result == 'sat' and counterfactual is None:
+            break
+          elif solver_result == 'sat':
+            next_counterfactual = counterfactual
+            norm_upper_bound = float(counterfactual[distance_key] + epsilon / 100) # not float64
+          elif solver_result == 'unsat':
+            norm_lower_bound = curr_norm_threshold
+          else:
             break
 
+        if next_counterfactual is None:
+          print('\tno further counterfactual found.', file = log_file)
+          break
+        next_counterfactual['time'] = time.time() - diverse_start_time
+        print(f'\tcounterfactual #{len(search_stats["diverse_counterfactuals"]) + 1}: distance {next_counterfactual[distance_key]:.6f} ({next_counterfactual["time"]:.4f}s).', file = log_file)
+        search_stats['diverse_counterfactuals'].append(next_counterfactual)
+
+    finally:
+      solver.pop()
+
+  def close(self):
+    if self.shared_search_state is not None:
+      self.shared_search_state.setdefault('counterfactual_samples', []).extend(
+        counterfactual['counterfactual_sample'] for counterfactual in self.counterfactuals[1:] + self.search_stats['diverse_counterfactuals']
+      )
+    if self.owns_shared_search_state and self.shared_search_state.get('solver') is not None:
+      self.shared_search_state['solver'].exit()
+
+
+def findClosestCounterfactualSample(model_trained, model_symbols, dataset_obj, factual_sample, norm_type, approach_string, epsilon, log_file, search_options=None):
+  # IMPORTANT: after trying the warm start candidates (if any), the closest
+  #            counterfactual is found in one of four ways: by minimizing the
+  #            distance directly (`opt`), by testing several thresholds at a
+  #            time on a pool of workers, by bisecting the number of changed
+  #            attributes (zero_norm), or by bisecting the distance on one
+  #            solver or a portfolio of solvers. Diverse counterfactuals (if
+  #            more than one is requested) are searched for afterwards.
+  if search_options is None:
+    search_options = getSearchOptions()
+  search = CounterfactualSearch(model_trained, model_symbols, dataset_obj, factual_sample, norm_type, approach_string, epsilon, log_file, search_options)
+  try:
+    search.warmStart()
+    if 'opt' in approach_string:
+      search.searchByOptimization()
+    elif search_options['num_workers'] > 1:
+      search.searchWithSolverPool()
+    elif norm_type == 'zero_norm' and search_options['exact_zero_norm'] and len(search_options['solver_names']) == 1 and search_options['incremental']:
+      search.searchZeroNorm()
+    else:
+      search.searchByBisection()
+    search.searchDiverseCounterfactuals()
+  finally:
+    search.close()
+
+  search_stats = search.search_stats
+  search_stats['optimality_gap'] = search_stats['norm_upper_bound'] - search_stats['norm_lower_bound']
+
   # IMPORTANT: there may be many more at this same distance! OR NONE! (what?? 2020.02.19)
+  counterfactuals = search.counterfactuals
   closest_counterfactual_sample = sorted(counterfactuals, key = lambda x: x['counterfactual_distance'])[0]
   closest_interventional_sample = sorted(counterfactuals, key = lambda x: x['interventional_distance'])[0]
 
-  return counterfactuals, closest_counterfactual_sample, closest_interventional_sample
+  return counterfactuals, closest_counterfactual_sample, closest_interventional_sample, search_stats
 
 
 def getPrettyStringForSampleDictionary(sample, dataset_obj):
@@ -766,7 +2004,13 @@ def getPySMTSampleFromDictSample(dict_sample, dataset_obj):
   return pysmt_sample
 
 
-def getDictSampleFromPySMTSample(pysmt_sample, dataset_obj, round=False):
+def getDictSampleFromPySMTSample(pysmt_sample, dataset_obj, round=False, split_thresholds=None):
+  # IMPORTANT: rounding up (to 5 decimals) may move a real value from the left
+  #            of a split (x <= threshold) to its right, e.g., a value at the
+  #            threshold itself, where the solver is often led by the distance.
+  #            Given the thresholds of the model's splits on each feature (see
+  #            getSplitThresholds), values are only rounded if rounding keeps
+  #            them on the same side of every threshold.
   dict_sample = {}
   for attr_name_kurz in dataset_obj.getInputOutputAttributeNames('kurz'):
     attr_obj = dataset_obj.attributes_kurz[attr_name_kurz]
@@ -779,7 +2023,10 @@ def getDictSampleFromPySMTSample(pysmt_sample, dataset_obj, round=False):
       elif attr_obj.attr_type == 'numeric-real':
         dict_sample[attr_name_kurz] = float(eval(str(pysmt_sample[attr_name_kurz])))
         if round:
-          dict_sample[attr_name_kurz] = round_decimals_up(dict_sample[attr_name_kurz], decimals=5)
+          rounded_value = round_decimals_up(dict_sample[attr_name_kurz], decimals=5)
+          if split_thresholds is None or \
+             np.searchsorted(split_thresholds[attr_name_kurz], rounded_value) == np.searchsorted(split_thresholds[attr_name_kurz], dict_sample[attr_name_kurz]):
+            dict_sample[attr_name_kurz] = rounded_value
       else: # refer to loadData.VALID_ATTRIBUTE_TYPES
         dict_sample[attr_name_kurz] = int(str(pysmt_sample[attr_name_kurz]))
     except:
@@ -787,6 +2034,84 @@ def getDictSampleFromPySMTSample(pysmt_sample, dataset_obj, round=False):
   return dict_sample
 
 
+def getCompactInputSymbols(model_symbols, dataset_obj, symbol_type):
+  # IMPORTANT: in the compact encoding, each one-hot categorical (ordinal)
+  #            attribute is a single Int symbol for the index (level) of its
+  #            category, and each binary attribute is a Bool symbol. The
+  #            sub-categorical (sub-ordinal) and binary inputs of the model and
+  #            distance formulas become terms derived from these symbols, so
+  #            that the one-hot (thermometer) plausibility constraints hold by
+  #            construction. Returns the compact symbols, keyed by the name of
+  #            the categorical (ordinal) parent or binary attribute.
+  compact_symbols = {}
+  dict_of_siblings_kurz = dataset_obj.getDictOfSiblings('kurz') if dataset_obj.is_one_hot else {'cat': {}, 'ord': {}}
+
+  for parent_name_kurz, sibling_names_kurz in dict_of_siblings_kurz['cat'].items():
+    category_symbol = Symbol(f'{parent_name_kurz}_{symbol_type}_compact', INT)
+    categories = [
+      category_idx
+      for category_idx, attr_name_kurz in enumerate(sibling_names_kurz)
+      if model_symbols[symbol_type][attr_name_kurz]['upper_bound'].constant_value() >= 1
+    ]
+    compact_symbols[parent_name_kurz] = {
+      'symbol': category_symbol,
+      'lower_bound': Int(min(categories)),
+      'upper_bound': Int(max(categories)),
+      'categories': categories, # allowed category indices
+    }
+    for category_idx, attr_name_kurz in enumerate(sibling_names_kurz): # already sorted
+      model_symbols[symbol_type][attr_name_kurz]['symbol'] = Ite(EqualsOrIff(category_symbol, Int(category_idx)), Int(1), Int(0))
+
+  for parent_name_kurz, sibling_names_kurz in dict_of_siblings_kurz['ord'].items():
+    level_symbol = Symbol(f'{parent_name_kurz}_{symbol_type}_compact', INT)
+    compact_symbols[parent_name_kurz] = {
+      'symbol': level_symbol,
+      'lower_bound': Int(sum(model_symbols[symbol_type][attr_name_kurz]['lower_bound'].constant_value() >= 1 for attr_name_kurz in sibling_names_kurz)),
+      'upper_bound': Int(sum(model_symbols[symbol_type][attr_name_kurz]['upper_bound'].constant_value() >= 1 for attr_name_kurz in sibling_names_kurz))
+    }
+    for level_idx, attr_name_kurz in enumerate(sibling_names_kurz): # already sorted
+      model_symbols[symbol_type][attr_name_kurz]['symbol'] = Ite(GE(level_symbol, Int(level_idx + 1)), Int(1), Int(0))
+
+  for attr_name_kurz in dataset_obj.getInputAttributeNames('kurz'):
+    if dataset_obj.attributes_kurz[attr_name_kurz].attr_type != 'binary':
+      continue
+    binary_symbol = Symbol(f'{attr_name_kurz}_{symbol_type}_compact', BOOL)
+    compact_symbols[attr_name_kurz] = {'symbol': binary_symbol}
+    attr_symbols = model_symbols[symbol_type][attr_name_kurz]
+    attr_symbols['symbol'] = Ite(binary_symbol, attr_symbols['upper_bound'], attr_symbols['lower_bound'])
+
+  return compact_symbols
+
+
+def getDerivedInputValues(model_symbols, symbol_type, model):
+  # values of the inputs that, in the compact encoding, are terms derived from
+  # the compact symbols (see getCompactInputSymbols); unconstrained Bool
+  # symbols may be missing from the model, and are then taken to be false.
+  # Models from worker processes (see parallelSolvers.runSolverWorker) are
+  # (name, value) strings, and the values of compact symbols are parsed back.
+  compact_symbols_by_name = {
+    compact_symbols['symbol'].symbol_name(): compact_symbols['symbol']
+    for compact_symbols in model_symbols['compact'][symbol_type].values()
+  }
+  symbol_values = {
+    symbol: FALSE()
+    for symbol in compact_symbols_by_name.values()
+    if symbol.symbol_type() == BOOL
+  }
+  for (symbol_key, symbol_value) in model:
+    if str(symbol_key) not in compact_symbols_by_name:
+      continue
+    symbol = compact_symbols_by_name[str(symbol_key)]
+    if isinstance(symbol_value, str):
+      symbol_value = Bool(symbol_value == 'True') if symbol.symbol_type() == BOOL else Int(int(symbol_value))
+    symbol_values[symbol] = symbol_value
+  return {
+    attr_name_kurz: attr_symbols['symbol'].substitute(symbol_values).simplify()
+    for attr_name_kurz, attr_symbols in model_symbols[symbol_type].items()
+    if not attr_symbols['symbol'].is_symbol()
+  }
+
+
 def genExp(
   explanation_file_name,
   model_trained,
@@ -795,8 +2120,8 @@ def genExp(
   norm_type,
   approach_string,
   epsilon,
-  min_diff=0,
-  outcome=None):
+  compact_encoding=False,
+  **search_options):
 
   # # ONLY TO BE USED FOR TEST PURPOSES ON MORTGAGE DATASET
   # factual_sample = {'x0': 75000, 'x1': 25000, 'y': False}
@@ -804,6 +2129,11 @@ def genExp(
   if 'mace' not in approach_string and 'mint' not in approach_string:
     raise Exception(f'`{approach_string}` not recognized as valid approach string; expected `mint` or `mace`.')
 
+  search_options = getSearchOptions(**search_options)
+  search_options['solver_names'] = getAvailableSolverNames(search_options['solver_names'])
+  if len(search_options['solver_names']) == 0:
+    raise Exception('None of the requested solvers are available.')
+
   start_time = time.time()
 
   if DEBUG_FLAG:
@@ -820,7 +2150,10 @@ def genExp(
   }
 
   # Populate model_symbols['counterfactual'/'interventional'] using the
-  # parameters saved during training
+  # parameters saved during training. Interventional symbols are only needed
+  # (and therefore defined) for MINT; for MACE, the counterfactual itself is
+  # the action, and model_symbols['interventional'] remains empty.
+  define_interventional_symbols = 'mint' in approach_string
   for attr_name_kurz in dataset_obj.getInputAttributeNames('kurz'):
     attr_obj = dataset_obj.attributes_kurz[attr_name_kurz]
     lower_bound = attr_obj.lower_bound
@@ -834,22 +2167,28 @@ def genExp(
         'lower_bound': Real(float(lower_bound)),
         'upper_bound': Real(float(upper_bound))
       }
-      model_symbols['interventional'][attr_name_kurz] = {
-        'symbol': Symbol(attr_name_kurz + '_interventional', REAL),
-        'lower_bound': Real(float(lower_bound)),
-        'upper_bound': Real(float(upper_bound))
-      }
+      if define_interventional_symbols:
+        model_symbols['interventional'][attr_name_kurz] = {
+          'symbol': Symbol(attr_name_kurz + '_interventional', REAL),
+          'lower_bound': Real(float(lower_bound)),
+          'upper_bound': Real(float(upper_bound))
+        }
     else: # refer to loadData.VALID_ATTRIBUTE_TYPES
       model_symbols['counterfactual'][attr_name_kurz] = {
         'symbol': Symbol(attr_name_kurz + '_counterfactual', INT),
         'lower_bound': Int(int(lower_bound)),
         'upper_bound': Int(int(upper_bound))
       }
-      model_symbols['interventional'][attr_name_kurz] = {
-        'symbol': Symbol(attr_name_kurz + '_interventional', INT),
-        'lower_bound': Int(int(lower_bound)),
-        'upper_bound': Int(int(upper_bound))
-      }
+      if define_interventional_symbols:
+        model_symbols['interventional'][attr_name_kurz] = {
+          'symbol': Symbol(attr_name_kurz + '_interventional', INT),
+          'lower_bound': Int(int(lower_bound)),
+          'upper_bound': Int(int(upper_bound))
+        }
+  model_symbols['compact'] = {'counterfactual': {}, 'interventional': {}}
+  if compact_encoding:
+    for symbol_type in getInputSymbolTypes(model_symbols):
+      model_symbols['compact'][symbol_type] = getCompactInputSymbols(model_symbols, dataset_obj, symbol_type)
   print('\n\n==============================================\n\n', file = log_file)
   print('Model Symbols:', file = log_file)
   print(model_symbols, log_file)
@@ -857,7 +2196,7 @@ def genExp(
   # factual_sample['y'] = False
 
   # find closest counterfactual sample from this negative sample
-  all_counterfactuals, closest_counterfactual_sample, closest_interventional_sample = findClosestCounterfactualSample(
+  all_counterfactuals, closest_counterfactual_sample, closest_interventional_sample, search_stats = findClosestCounterfactualSample(
     model_trained,
     model_symbols,
     dataset_obj,
@@ -866,8 +2205,7 @@ def genExp(
     approach_string,
     epsilon,
     log_file,
-    min_diff=min_diff,
-    outcome=outcome
+    search_options
   )
 
   print('\n', file = log_file)
@@ -880,25 +2218,44 @@ def genExp(
     print(f"Nearest resulting CF sample:\t {getPrettyStringForSampleDictionary(closest_interventional_sample['counterfactual_sample'], dataset_obj)} (verified)", file = log_file)
     print(f"Minimum interventional distance: {closest_interventional_sample['interventional_distance']:.6f}", file = log_file)
     print(f"Minimum resulting CF distance:\t {closest_interventional_sample['counterfactual_distance']:.6f}", file = log_file)
+  print(f"Search status:\t\t\t {search_stats['status']} ({search_stats['iterations']} solver calls, {search_stats['solver_time']:.4f}s, optimality gap {search_stats['optimality_gap']:.6f})", file = log_file)
 
   end_time = time.time()
 
   if 'mace' in approach_string:
-    return {
+    explanation = {
       'fac_sample': factual_sample,
       'cfe_found': True,
       'cfe_plausible': True,
       'cfe_time': end_time - start_time,
       'cfe_sample': closest_counterfactual_sample['counterfactual_sample'],
       'cfe_distance': closest_counterfactual_sample['counterfactual_distance'],
+      'search_status': search_stats['status'],
+      'search_iterations': search_stats['iterations'],
+      'search_solver_time': search_stats['solver_time'],
+      'search_lower_bound': search_stats['norm_lower_bound'],
+      'search_upper_bound': search_stats['norm_upper_bound'],
+      'optimality_gap': search_stats['optimality_gap'],
+      'search_solver_wins': search_stats['solver_wins'],
+      'search_warm_start_distance': search_stats['warm_start_distance'],
       # 'all_counterfactuals': all_counterfactuals
     }
+    if search_options['num_counterfactuals'] > 1:
+      explanation['cfe_top_k'] = [
+        {
+          'cfe_sample': counterfactual['counterfactual_sample'],
+          'cfe_distance': counterfactual['counterfactual_distance'],
+          'cfe_time': counterfactual['time'],
+        }
+        for counterfactual in search_stats['diverse_counterfactuals']
+      ]
+    return explanation
   elif 'mint' in approach_string:
     action_set = {}
     for attr_name_kurz in dataset_obj.getInputAttributeNames('kurz'):
       if factual_sample[attr_name_kurz] != closest_interventional_sample['interventional_sample'][attr_name_kurz]:
         action_set[attr_name_kurz] = closest_interventional_sample['interventional_sample'][attr_name_kurz]
-    return {
+    explanation = {
       'fac_sample': factual_sample,
       'scf_found': True,
       'scf_plausible': True,
@@ -910,8 +2267,72 @@ def genExp(
       # 'action_set': action_set,
       'int_set': action_set,
       'int_cost': closest_interventional_sample['interventional_distance'],
+      'search_status': search_stats['status'],
+      'search_iterations': search_stats['iterations'],
+      'search_solver_time': search_stats['solver_time'],
+      'search_lower_bound': search_stats['norm_lower_bound'],
+      'search_upper_bound': search_stats['norm_upper_bound'],
+      'optimality_gap': search_stats['optimality_gap'],
+      'search_solver_wins': search_stats['solver_wins'],
       # 'all_counterfactuals': all_counterfactuals
     }
+    if search_options['num_counterfactuals'] > 1:
+      explanation['scf_top_k'] = [
+        {
+          'scf_sample': counterfactual['counterfactual_sample'],
+          'scf_distance': counterfactual['counterfactual_distance'],
+          'int_sample': counterfactual['interventional_sample'],
+          'int_cost': counterfactual['interventional_distance'],
+          'scf_time': counterfactual['time'],
+        }
+        for counterfactual in search_stats['diverse_counterfactuals']
+      ]
+    return explanation
+
+
+def genExpForAllNorms(
+  explanation_file_name,
+  model_trained,
+  dataset_obj,
+  factual_sample,
+  norm_types,
+  approach_string,
+  epsilon,
+  warm_start_samples=None,
+  time_budget=None,
+  **kwargs):
+
+  # Runs genExp for several norms on the same factual sample, sharing the
+  # encoding (via the formula cache) and one incremental solver between them.
+  # For MACE, every counterfactual found for one norm is also a feasible point
+  # for the others, and is used to warm-start their searches. The log of each
+  # norm goes to its own file, e.g., sample_0_one_norm.txt. A time budget is
+  # for all norms together, and is split evenly across the remaining norms.
+  if not kwargs.get('cache_formulas', True):
+    raise Exception('Searching for several norms requires `cache_formulas`.')
+
+  shared_search_state = {}
+  deadline = time.time() + time_budget if time_budget is not None else None
+  explanation_file_name_root, explanation_file_name_extension = os.path.splitext(explanation_file_name)
+  explanations = {}
+  try:
+    for norm_idx, norm_type in enumerate(norm_types):
+      explanations[norm_type] = genExp(
+        f'{explanation_file_name_root}_{norm_type}{explanation_file_name_extension}',
+        model_trained,
+        dataset_obj,
+        factual_sample,
+        norm_type,
+        approach_string,
+        epsilon,
+        warm_start_samples=((warm_start_samples or []) + shared_search_state.get('counterfactual_samples', [])) or None,
+        shared_search_state=shared_search_state,
+        time_budget=None if deadline is None else max(deadline - time.time(), 0) / (len(norm_types) - norm_idx),
+        **kwargs)
+  finally:
+    if shared_search_state.get('solver') is not None:
+      shared_search_state['solver'].exit()
+  return explanations
 
 
 
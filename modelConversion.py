@@ -1,3 +1,4 @@
+import sys
 import graphviz
 import numpy as np
 from sklearn.tree import _tree, DecisionTreeClassifier, DecisionTreeRegressor, export_text
@@ -5,6 +6,7 @@ from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.neural_network import MLPClassifier, MLPRegressor
 from pysmt.shortcuts import *
 from pysmt.typing import *
+from utils import getMLPPreactivationBounds, getCanonicalSplitThreshold
 
 # # Hoare triple examples:
 #     # https://www.cs.cmu.edu/~aldrich/courses/654-sp07/slides/7-hoare.pdf
@@ -89,7 +91,28 @@ def tree2c(tree, feature_names, return_value = 'class_idx_max', tree_idx = ''):
     return '\n'.join(lines)
 
 
-def tree2formula(tree, model_symbols, return_value='class_idx_max', tree_idx=''):
+# tree_encoding of tree2formula: 'nested' (nested Or/And over the splits) or
+# 'leaf_indicators' (one Boolean per node); by default (None), trees at least
+# LEAF_INDICATOR_MIN_DEPTH deep use leaf indicators, as the nested encoding
+# recurses once per level
+TREE_ENCODINGS = ('nested', 'leaf_indicators')
+LEAF_INDICATOR_MIN_DEPTH = sys.getrecursionlimit() // 2
+
+
+def getSplitDirection(feature_domains, name, threshold):
+    # 'left' ('right') if every value in the (lower, upper) domain of the
+    # feature goes left (right) at the split, or None if both are possible
+    if feature_domains is None or name not in feature_domains:
+        return None
+    lower_bound, upper_bound = feature_domains[name]
+    if upper_bound <= threshold:
+        return 'left'
+    elif lower_bound > threshold:
+        return 'right'
+    return None
+
+
+def tree2formula(tree, model_symbols, return_value='class_idx_max', tree_idx='', split_literals=None, tree_encoding=None, feature_domains=None):
     tree_ = tree.tree_
     n_classes = tree.n_classes_
     feature_names = list(model_symbols['counterfactual'].keys())
@@ -99,36 +122,103 @@ def tree2formula(tree, model_symbols, return_value='class_idx_max', tree_idx='')
     ]
     problem_type = 'classification' if isinstance(tree, DecisionTreeClassifier) else 'regression'
 
+    def getSplitLiteral(node):
+        name = feature_name[node]
+        threshold = getCanonicalThreshold(model_symbols, name, float(tree_.threshold[node]))
+        if split_literals is not None:
+            return split_literals[name][threshold]
+        return LE(ToReal(model_symbols['counterfactual'][name]['symbol']), Real(threshold))
+
+    def getLeafFormula(node):
+        if problem_type == 'classification':
+            if return_value == 'class_idx_max':
+                values = list(tree_.value[node][0])
+                output = values.index(max(values))
+                return EqualsOrIff(model_symbols['output']['y']['symbol'], Int(output))
+            elif return_value == 'class_prob_array':
+                prob_array = list(np.divide(tree_.value[node][0], np.sum(tree_.value[node][0])))
+                return And(
+                    EqualsOrIff(model_symbols['aux'][f'p{i}{tree_idx}']['symbol'], Real(float(prob_array[i]))) for i in range(n_classes)
+                )
+        else:
+            output = float(tree_.value[node][0][0])
+            return Equals(model_symbols['output']['y']['symbol'], Real(output))
+
+    # IMPORTANT: with per-sample feature_domains (e.g., immutable features
+    #            pinned to their factual value), splits whose direction is
+    #            decided by the domain are skipped, and the subtrees that
+    #            cannot be reached are never encoded.
+    def getSplitDirectionFor(node):
+        name = feature_name[node]
+        return getSplitDirection(feature_domains, name, getCanonicalThreshold(model_symbols, name, float(tree_.threshold[node])))
+
     def recurse(node):
         if tree_.feature[node] != _tree.TREE_UNDEFINED:
-            name = feature_name[node]
-            threshold = float(tree_.threshold[node]) - 0.00001
+            split_direction = getSplitDirectionFor(node)
+            if split_direction == 'left':
+                return recurse(tree_.children_left[node])
+            elif split_direction == 'right':
+                return recurse(tree_.children_right[node])
+            split_literal = getSplitLiteral(node)
             return Or(
                 And(
-                    LE(ToReal(model_symbols['counterfactual'][name]['symbol']), Real(threshold)),
+                    split_literal,
                     recurse(tree_.children_left[node])
                 ),
                 And(
-                    Not(LE(ToReal(model_symbols['counterfactual'][name]['symbol']), Real(threshold))),
+                    Not(split_literal),
                     recurse(tree_.children_right[node])
                 )
             )
         else:
-            if problem_type == 'classification':
-                if return_value == 'class_idx_max':
-                    values = list(tree_.value[node][0])
-                    output = values.index(max(values))
-                    return EqualsOrIff(model_symbols['output']['y']['symbol'], Int(output))
-                elif return_value == 'class_prob_array':
-                    prob_array = list(np.divide(tree_.value[node][0], np.sum(tree_.value[node][0])))
-                    return And(
-                        EqualsOrIff(model_symbols['aux'][f'p{i}{tree_idx}']['symbol'], Real(float(prob_array[i]))) for i in range(n_classes)
-                    )
-            else:
-                output = float(tree_.value[node][0][0])
-                return Equals(model_symbols['output']['y']['symbol'], Real(output))
-
-    return recurse(0)
+            return getLeafFormula(node)
+
+    if tree_encoding is None:
+        tree_encoding = 'leaf_indicators' if tree_.max_depth >= LEAF_INDICATOR_MIN_DEPTH else 'nested'
+    if tree_encoding not in TREE_ENCODINGS:
+        raise Exception(f'{tree_encoding} not recognized as a valid `tree_encoding`.')
+    if tree_encoding == 'nested':
+        return recurse(0)
+
+    # IMPORTANT: a flat alternative to the nested encoding above, built without
+    #            recursion and linear in the number of nodes: each node gets a
+    #            Boolean that implies that its parent is reached and that the
+    #            parent's split goes its way, so each leaf implies its path.
+    #            At least one leaf is reached, and at most one can be (two
+    #            paths disagree on the split where they diverge); the reached
+    #            leaf implies its output value. On the (shallow) trees of this
+    #            repo, the nested encoding solves faster, so this one is only
+    #            used by default for trees too deep to recurse over (see
+    #            TREE_ENCODINGS).
+    # (children have larger indices than their parents in sklearn trees)
+    is_reachable = np.zeros(tree_.node_count, dtype = bool)
+    is_reachable[0] = True
+    node_literals = [TRUE()] + [
+        Symbol(f'tree{tree_idx}_node{node}', BOOL)
+        for node in range(1, tree_.node_count)
+    ]
+    node_formulas = []
+    for node in np.flatnonzero(tree_.children_left != _tree.TREE_LEAF):
+        if not is_reachable[node]:
+            continue
+        split_direction = getSplitDirectionFor(node)
+        if split_direction is None:
+            left_literal, right_literal = getSplitLiteral(node), Not(getSplitLiteral(node))
+        else:
+            left_literal, right_literal = TRUE(), TRUE() # only one child is reachable
+        if split_direction != 'right':
+            is_reachable[tree_.children_left[node]] = True
+            node_formulas.append(Implies(node_literals[tree_.children_left[node]], And(node_literals[node], left_literal)))
+        if split_direction != 'left':
+            is_reachable[tree_.children_right[node]] = True
+            node_formulas.append(Implies(node_literals[tree_.children_right[node]], And(node_literals[node], right_literal)))
+    leaf_nodes = np.flatnonzero((tree_.children_left == _tree.TREE_LEAF) & is_reachable)
+    node_formulas.append(Or([node_literals[node] for node in leaf_nodes]))
+    node_formulas.extend(
+        Implies(node_literals[node], getLeafFormula(node))
+        for node in leaf_nodes
+    )
+    return And(node_formulas)
 
 
 ################################################################################
@@ -189,8 +279,74 @@ def forest2c(forest, feature_names):
     return '\n'.join(lines)
 
 
-def forest2formula(forest, model_symbols):
+def getCanonicalThreshold(model_symbols, name, threshold):
+    # see utils.getCanonicalSplitThreshold
+    is_integer_based = model_symbols['counterfactual'][name]['symbol'].get_type() == INT
+    return getCanonicalSplitThreshold(threshold, is_integer_based)
+
+
+def getSplitThresholds(model, model_symbols):
+    # {feature: sorted canonical thresholds of all splits on the feature} of a
+    # tree or of all trees of a forest; a value goes left at the split iff it is
+    # at most the threshold
+    feature_names = list(model_symbols['counterfactual'].keys())
+    if isinstance(model, RandomForestClassifier) or isinstance(model, RandomForestRegressor):
+        estimators = model.estimators_
+    else:
+        estimators = [model]
+    thresholds = {name: set() for name in feature_names}
+    for estimator in estimators:
+        for node in np.flatnonzero(estimator.tree_.feature != _tree.TREE_UNDEFINED):
+            name = feature_names[estimator.tree_.feature[node]]
+            thresholds[name].add(getCanonicalThreshold(model_symbols, name, float(estimator.tree_.threshold[node])))
+    return {name: np.array(sorted(thresholds[name])) for name in feature_names}
+
+
+def getForestSplitLiterals(forest, model_symbols, feature_domains=None):
+    # IMPORTANT: the trees of a forest compare each feature against hundreds of
+    #            (often nearby, or equivalent) thresholds. All splits on the
+    #            same canonical threshold share one atom x <= c (for integer-
+    #            based features, a pure integer atom, without ToReal), and the
+    #            distinct thresholds c_1 < ... < c_m of each feature form a
+    #            ladder (x <= c_j) -> (x <= c_{j+1}), so that their order is
+    #            known to the SAT core up front. Returns {feature: {threshold:
+    #            atom}} and the ladder.
+    feature_names = list(model_symbols['counterfactual'].keys())
+    thresholds = {name: set() for name in feature_names}
+    for estimator in forest.estimators_:
+        for node in range(estimator.tree_.node_count):
+            if estimator.tree_.feature[node] != _tree.TREE_UNDEFINED:
+                name = feature_names[estimator.tree_.feature[node]]
+                threshold = getCanonicalThreshold(model_symbols, name, float(estimator.tree_.threshold[node]))
+                if getSplitDirection(feature_domains, name, threshold) is not None:
+                    continue # decided by the domain of the feature
+                thresholds[name].add(threshold)
+
+    split_literals = {}
+    ladder_formula = []
+    for name in feature_names:
+        split_literals[name] = {}
+        feature_symbol = model_symbols['counterfactual'][name]['symbol']
+        previous_literal = None
+        for threshold in sorted(thresholds[name]):
+            if feature_symbol.get_type() == INT:
+                split_literal = LE(feature_symbol, Int(threshold))
+            else:
+                split_literal = LE(feature_symbol, Real(threshold))
+            split_literals[name][threshold] = split_literal
+            if previous_literal is not None:
+                ladder_formula.append(Implies(previous_literal, split_literal))
+            previous_literal = split_literal
+
+    return split_literals, And(ladder_formula)
+
+
+def forest2formula(forest, model_symbols, shared_splits=True, feature_domains=None, tree_encoding=None):
     model_symbols['aux'] = {}
+    if shared_splits:
+        split_literals, ladder_formula = getForestSplitLiterals(forest, model_symbols, feature_domains)
+    else:
+        split_literals, ladder_formula = None, TRUE()
     problem_type = 'classification' if isinstance(forest, RandomForestClassifier) else 'regression'
     if problem_type == 'classification':
         n_classes = forest.n_classes_
@@ -199,7 +355,7 @@ def forest2formula(forest, model_symbols):
                 model_symbols['aux'][f'p{i}{tree_idx}'] = {'symbol': Symbol(f'p{i}{tree_idx}', REAL)}
 
         tree_formulas = And([
-            tree2formula(forest.estimators_[tree_idx], model_symbols, return_value = 'class_prob_array', tree_idx = tree_idx)
+            tree2formula(forest.estimators_[tree_idx], model_symbols, return_value = 'class_prob_array', tree_idx = tree_idx, split_literals = split_literals, tree_encoding = tree_encoding, feature_domains = feature_domains)
             for tree_idx in range(len(forest.estimators_))
         ])
 
@@ -213,25 +369,44 @@ def forest2formula(forest, model_symbols):
                 EqualsOrIff(model_symbols['output']['y']['symbol'], Int(1)),
             )
         else:
-            items = tuple(Plus([model_symbols['aux'][f'p{j}{tree_idx}']['symbol'] for tree_idx in range(len(forest.estimators_))]) for j in range(n_classes))
-            max_formula = Max(
-                    items
-                )
-
-            output_formula = And([
-                Ite(
-                    EqualsOrIff(max_formula, Plus([model_symbols['aux'][f'p{k}{tree_idx}']['symbol'] for tree_idx in range(len(forest.estimators_))])),
-                    EqualsOrIff(model_symbols['output']['y']['symbol'], Int(k)),
-                    NotEquals(model_symbols['output']['y']['symbol'], Int(k))
+            # IMPORTANT: the score (sum of votes) of each class is defined once,
+            #            and predicting class k requires k to beat every other
+            #            class pairwise: strictly those before k, and at least
+            #            ties those after k, as sklearn's argmax takes the first
+            #            of the highest scores. With the desired outcome (or the
+            #            factual class) fixed, the solver only ever needs the
+            #            pairwise constraints of the classes y can still take.
+            for k in range(n_classes):
+                model_symbols['aux'][f'score{k}'] = {'symbol': Symbol(f'score{k}', REAL)}
+            score_formula = And([
+                EqualsOrIff(
+                    model_symbols['aux'][f'score{k}']['symbol'],
+                    Plus([model_symbols['aux'][f'p{k}{tree_idx}']['symbol'] for tree_idx in range(len(forest.estimators_))])
                 )
                 for k in range(n_classes)
             ])
+
+            output_formula = And(
+                score_formula,
+                Or([EqualsOrIff(model_symbols['output']['y']['symbol'], Int(k)) for k in range(n_classes)]),
+                And([
+                    Implies(
+                        EqualsOrIff(model_symbols['output']['y']['symbol'], Int(k)),
+                        And([
+                            (GT if j < k else GE)(model_symbols['aux'][f'score{k}']['symbol'], model_symbols['aux'][f'score{j}']['symbol'])
+                            for j in range(n_classes)
+                            if j != k
+                        ])
+                    )
+                    for k in range(n_classes)
+                ])
+            )
     else:
         for tree_idx in range(len(forest.estimators_)):
             model_symbols['aux'][f'v{tree_idx}'] = {'symbol': Symbol(f'v{tree_idx}', REAL)}
 
         tree_formulas = And([
-            tree2formula(forest.estimators_[tree_idx], model_symbols, tree_idx = tree_idx)
+            tree2formula(forest.estimators_[tree_idx], model_symbols, tree_idx = tree_idx, split_literals = split_literals, tree_encoding = tree_encoding, feature_domains = feature_domains)
             for tree_idx in range(forest.n_estimators)
         ])
 
@@ -244,6 +419,7 @@ def forest2formula(forest, model_symbols):
         )
 
     return And(
+        ladder_formula,
         tree_formulas,
         output_formula
     )
@@ -445,6 +621,48 @@ def mlp2c(model, feature_names):
     return '\n'.join(lines)
 
 
+# margin (on pre-activations) below which a ReLU is not considered stable, as
+# bounds are propagated in floating point
+MLP_BOUND_TOLERANCE = 1e-6
+
+
+def getMLPInputBounds(model_symbols):
+    # data range of each input, in the order of the rows of model.coefs_[0]
+    return [
+        (float(symbols['lower_bound'].constant_value()), float(symbols['upper_bound'].constant_value()))
+        for symbols in model_symbols['counterfactual'].values()
+    ]
+
+
+def getMLPNeuronPhase(preactivation_bounds, layer_idx, feature_idx):
+    # 'active', 'inactive', or None (unstable) for the neuron f_{layer_idx}_{feature_idx}
+    pre_lower, pre_upper = preactivation_bounds[layer_idx - 1]
+    if pre_lower[feature_idx] > MLP_BOUND_TOLERANCE:
+        return 'active'
+    elif pre_upper[feature_idx] < -MLP_BOUND_TOLERANCE:
+        return 'inactive'
+    return None
+
+
+def mlp2phaseformula(model, model_symbols, input_bounds):
+    # Fixes the sign of the pre-activation of every ReLU that is stable when the
+    # inputs are within input_bounds (e.g., tighter than their data range, for
+    # a given factual sample), which decides the Ite of that neuron in the
+    # formula of mlp2formula. This is only sound if the inputs are indeed
+    # constrained to input_bounds.
+    preactivation_bounds = getMLPPreactivationBounds(model, input_bounds)
+    phase_formula = []
+    for layer_idx in range(1, len(model.coefs_) + 1):
+        for feature_idx in range(model.coefs_[layer_idx - 1].shape[1]):
+            pre_nonlin_symbol = Symbol('f_{}_{}_pre_nonlin'.format(layer_idx, feature_idx), REAL)
+            phase = getMLPNeuronPhase(preactivation_bounds, layer_idx, feature_idx)
+            if phase == 'active':
+                phase_formula.append(GE(pre_nonlin_symbol, Real(0)))
+            elif phase == 'inactive':
+                phase_formula.append(Not(GE(pre_nonlin_symbol, Real(0))))
+    return And(phase_formula)
+
+
 def mlp2formula(model, model_symbols):
     problem_type = 'classification' if isinstance(model, MLPClassifier) else 'regression'
     n_classes = 2 if model.n_outputs_ == 1 else model.n_outputs_
@@ -462,6 +680,8 @@ def mlp2formula(model, model_symbols):
             model_symbols['aux'][feature_string_1] = {'symbol': Symbol(feature_string_1, REAL)}
             model_symbols['aux'][feature_string_2] = {'symbol': Symbol(feature_string_2, REAL)}
 
+    # ReLUs that are stable over the whole data range need no Ite
+    preactivation_bounds = getMLPPreactivationBounds(model, getMLPInputBounds(model_symbols))
 
     formula_assign_feature_values = []
     for layer_idx in range(1, len(layer_widths)):
@@ -506,14 +726,21 @@ def mlp2formula(model, model_symbols):
             )
 
 
+            phase = getMLPNeuronPhase(preactivation_bounds, layer_idx, curr_layer_feature_idx)
+            if phase == 'active':
+                post_nonlin_value = model_symbols['aux'][curr_layer_feature_string_1]['symbol']
+            elif phase == 'inactive':
+                post_nonlin_value = Real(0)
+            else:
+                post_nonlin_value = Ite(
+                    GE(model_symbols['aux'][curr_layer_feature_string_1]['symbol'], Real(0)),
+                    model_symbols['aux'][curr_layer_feature_string_1]['symbol'],
+                    Real(0)
+                )
             formula_assign_feature_values.append(
                 EqualsOrIff(
                     model_symbols['aux'][curr_layer_feature_string_2]['symbol'],
-                    Ite(
-                        GE(model_symbols['aux'][curr_layer_feature_string_1]['symbol'], Real(0)),
-                        model_symbols['aux'][curr_layer_feature_string_1]['symbol'],
-                        Real(0)
-                    )
+                    post_nonlin_value
                 )
             )
 
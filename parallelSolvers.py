@@ -0,0 +1,256 @@
+import io
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+
+from pysmt.shortcuts import *
+from pysmt.typing import *
+from pysmt.exceptions import SolverReturnedUnknownResultError
+from pysmt.smtlib.parser import SmtLibParser
+from pysmt.smtlib.script import smtlibscript_from_formula
+
+
+# IMPORTANT: pysmt FNodes cannot be pickled, and therefore cannot be shipped to
+#            worker processes as they are. Instead, formulas are serialized to
+#            SMT-LIB strings in the main process and parsed again in workers.
+#            Because symbols are identified by their name and type, the parsed
+#            formula refers to the same symbols as the original one.
+
+def serializeFormula(formula):
+  script = smtlibscript_from_formula(formula)
+  string_buffer = io.StringIO()
+  script.serialize(string_buffer, daggify=True)
+  return string_buffer.getvalue()
+
+
+def deserializeFormula(formula_string):
+  script = SmtLibParser().get_script(io.StringIO(formula_string))
+  return script.get_last_formula()
+
+
+def getAvailableSolverNames(solver_names):
+  available_solver_names = get_env().factory.all_solvers().keys()
+  for solver_name in solver_names:
+    if solver_name not in available_solver_names:
+      print(f'[ENV WARNING] solver `{solver_name}` not available; run `pysmt-install --{solver_name}` to race it.')
+  return [solver_name for solver_name in solver_names if solver_name in available_solver_names]
+
+
+class SolverWorkersFailedError(Exception):
+  # raised by SolverPool.receive once every worker has been dropped
+  pass
+
+
+def setSolverTimeout(solver, timeout):
+  # IMPORTANT: only z3 exposes a per-query timeout (in milliseconds) through
+  #            pysmt; queries on other backends are not interrupted, so that
+  #            time budgets are only enforced between their queries (or by
+  #            killing the worker processes that run them).
+  if hasattr(solver, 'z3'):
+    solver.z3.set('timeout', max(int(timeout * 1000), 1) if timeout is not None else 4294967295)
+
+
+def runSolverWorker(solver_name, formula_string, connection):
+  # Runs in a separate process: asserts the (threshold-independent) formula
+  # once, and then answers queries, each of which is a formula that is pushed,
+  # solved together with the base formula, and popped again.
+  try:
+    solver = Solver(name=solver_name)
+    solver.add_assertion(deserializeFormula(formula_string))
+  except Exception as e:
+    connection.send(('error', None, 0, str(e)))
+    return
+
+  while True:
+    query = connection.recv()
+    if query is None:
+      break
+    query_string, timeout = query
+
+    try:
+      setSolverTimeout(solver, timeout)
+      solver.push()
+      solver.add_assertion(deserializeFormula(query_string))
+      query_start_time = time.time()
+      try:
+        solver_result = 'sat' if solver.solve() else 'unsat'
+      except SolverReturnedUnknownResultError:
+        solver_result = 'unknown'
+      query_end_time = time.time()
+      # symbols and values are sent as strings; see getDictSampleFromPySMTSample
+      model = [
+        (str(symbol_key), str(symbol_value))
+        for (symbol_key, symbol_value) in solver.get_model()
+      ] if solver_result == 'sat' else None
+      solver.pop()
+    except Exception as e:
+      connection.send(('error', None, 0, str(e)))
+      return
+
+    connection.send((solver_result, model, query_end_time - query_start_time, None))
+
+  solver.exit()
+
+
+class SolverWorker(object):
+
+  def __init__(self, solver_name, formula_string):
+    self.solver_name = solver_name
+    self.formula_string = formula_string
+    self.start()
+
+  def start(self):
+    self.connection, child_connection = multiprocessing.Pipe()
+    self.process = multiprocessing.Process(
+      target = runSolverWorker,
+      args = (self.solver_name, self.formula_string, child_connection),
+      daemon = True)
+    self.process.start()
+    child_connection.close()
+    self.busy = False
+
+  def submit(self, query_string, timeout=None):
+    try:
+      self.connection.send((query_string, timeout))
+    except (BrokenPipeError, OSError):
+      # the worker has already exited (e.g., it could not parse the formula);
+      # its error (or EOF) is picked up by receive, like any other answer
+      pass
+    self.busy = True
+
+  def receive(self):
+    self.busy = False
+    try:
+      return self.connection.recv()
+    except EOFError:
+      return ('error', None, 0, f'solver `{self.solver_name}` exited unexpectedly.')
+
+  def restart(self):
+    # the only way to cancel a query that is no longer needed
+    self.terminate()
+    self.start()
+
+  def terminate(self):
+    self.process.terminate()
+    self.process.join()
+    self.connection.close()
+
+  def close(self):
+    if self.busy or not self.process.is_alive():
+      self.terminate()
+      return
+    try:
+      self.connection.send(None)
+    except (BrokenPipeError, OSError):
+      pass
+    self.process.join(timeout = 1)
+    self.terminate()
+
+
+class SolverPortfolio(object):
+  # Races the same queries on several SMT backends (one process per backend)
+  # and takes the first definitive (SAT or UNSAT) answer. Workers that are
+  # still busy on an already-answered query are killed and restarted.
+
+  def __init__(self, solver_names, formula):
+    formula_string = serializeFormula(formula)
+    self.workers = [SolverWorker(solver_name, formula_string) for solver_name in solver_names]
+
+  def solve(self, query_formula, timeout=None):
+    query_string = serializeFormula(query_formula)
+    for worker in self.workers:
+      worker.submit(query_string, timeout)
+
+    deadline = time.time() + timeout if timeout is not None else None
+    pending_workers = {worker.connection: worker for worker in self.workers}
+    while len(pending_workers) > 0:
+      ready_connections = wait(list(pending_workers.keys()), None if deadline is None else max(deadline - time.time(), 0))
+      if len(ready_connections) == 0:
+        # out of time; e.g., backends without a timeout of their own
+        for worker in pending_workers.values():
+          worker.restart()
+        break
+      for connection in ready_connections:
+        worker = pending_workers.pop(connection)
+        solver_result, model, solve_time, error_message = worker.receive()
+        if solver_result == 'error':
+          # e.g., the backend does not support the logic of the formula
+          print(f'[WARNING] dropping solver `{worker.solver_name}` from portfolio: {error_message}')
+          worker.terminate()
+          self.workers.remove(worker)
+        elif solver_result in {'sat', 'unsat'}:
+          for other_worker in pending_workers.values():
+            other_worker.restart()
+          return solver_result, model, solve_time, worker.solver_name
+
+    return 'unknown', None, 0, None
+
+  def close(self):
+    for worker in self.workers:
+      worker.close()
+
+
+class SolverPool(object):
+  # A fixed number of workers, each holding its own incremental solver over the
+  # same formula, to which queries are dispatched as soon as a worker is idle.
+  # Each query carries a tag (e.g., its norm threshold) so that queries which
+  # are no longer needed can be cancelled by tag.
+
+  def __init__(self, solver_names, formula, num_workers):
+    formula_string = serializeFormula(formula)
+    self.workers = [
+      SolverWorker(solver_names[worker_idx % len(solver_names)], formula_string)
+      for worker_idx in range(num_workers)
+    ]
+    self.queued_queries = [] # list of (tag, query_string, timeout)
+    self.running_queries = {} # worker --> tag
+
+  def dispatch(self):
+    for worker in self.workers:
+      if not worker.busy and len(self.queued_queries) > 0:
+        query_tag, query_string, timeout = self.queued_queries.pop(0)
+        worker.submit(query_string, timeout)
+        self.running_queries[worker] = query_tag
+
+  def submit(self, query_formula, query_tag, timeout=None):
+    self.queued_queries.append((query_tag, serializeFormula(query_formula), timeout))
+    self.dispatch()
+
+  def hasPending(self):
+    return len(self.queued_queries) > 0 or len(self.running_queries) > 0
+
+  def receive(self, timeout=None):
+    # blocks until the next running query is answered, or returns None if
+    # none is answered within the timeout
+    if len(self.workers) == 0:
+      raise SolverWorkersFailedError('All solver workers have failed.')
+    workers_by_connection = {worker.connection: worker for worker in self.running_queries.keys()}
+    ready_connections = wait(list(workers_by_connection.keys()), timeout)
+    if len(ready_connections) == 0:
+      return None
+    worker = workers_by_connection[ready_connections[0]]
+    query_tag = self.running_queries.pop(worker)
+    solver_result, model, solve_time, error_message = worker.receive()
+    if solver_result == 'error':
+      print(f'[WARNING] dropping solver `{worker.solver_name}` from pool: {error_message}')
+      worker.terminate()
+      self.workers.remove(worker)
+      solver_result = 'unknown'
+    self.dispatch()
+    return query_tag, solver_result, model, solve_time, worker.solver_name
+
+  def cancel(self, should_cancel):
+    self.queued_queries = [
+      (query_tag, query_string, timeout)
+      for (query_tag, query_string, timeout) in self.queued_queries
+      if not should_cancel(query_tag)
+    ]
+    for worker, query_tag in list(self.running_queries.items()):
+      if should_cancel(query_tag):
+        del self.running_queries[worker]
+        worker.restart()
+    self.dispatch()
+
+  def close(self):
+    for worker in self.workers:
+      worker.close()
@@ -0,0 +1,73 @@
+import warnings
+
+import numpy as np
+import pytest
+
+import loadData
+import loadModel
+import generateLeafExplanations
+import generateSATExplanations
+
+warnings.filterwarnings('ignore')
+
+
+@pytest.fixture(scope = 'module')
+def irisTree():
+  dataset_obj = loadData.loadDataset('iris', return_one_hot = False, load_from_cache = False, debug_flag = False)
+  model_trained = loadModel.loadModelForDataset('tree', 'iris')
+  X_train, X_test, y_train, y_test = dataset_obj.getTrainTestSplit()
+  X_test = X_test.copy()
+  X_test['y'] = model_trained.predict(X_test)
+  factual_samples = list(X_test.where(X_test['y'] == 0).dropna()[:5].T.to_dict().values())
+  for factual_sample in factual_samples:
+    factual_sample['y'] = int(factual_sample['y'])
+  return dataset_obj, model_trained, factual_samples
+
+
+def test_irisTreeHasThresholdsRoundedUpInFloat32(irisTree):
+  dataset_obj, model_trained, factual_samples = irisTree
+  thresholds = model_trained.tree_.threshold[model_trained.tree_.feature >= 0]
+  assert np.any(np.float32(thresholds) > thresholds)
+
+
+def test_leafBoxesAreTight(irisTree):
+  # the bounds of each box go to its leaf, and the next values beyond them do not
+  dataset_obj, model_trained, factual_samples = irisTree
+  lower, upper, classes = generateLeafExplanations.getLeafBoxes(model_trained, dataset_obj)
+  leaf_nodes = np.where(model_trained.tree_.children_left == -1)[0]
+  for leaf_idx, leaf_node in enumerate(leaf_nodes):
+    inner_point = np.where(np.isfinite(lower[leaf_idx]), lower[leaf_idx], np.where(np.isfinite(upper[leaf_idx]), upper[leaf_idx], 0.))
+    for feature_idx in range(lower.shape[1]):
+      for bound, direction in [(lower[leaf_idx, feature_idx], -np.inf), (upper[leaf_idx, feature_idx], np.inf)]:
+        if not np.isfinite(bound):
+          continue
+        point = inner_point.copy()
+        point[feature_idx] = bound
+        assert model_trained.apply(point.reshape(1, -1).astype(np.float32))[0] == leaf_node
+        point[feature_idx] = np.nextafter(bound, direction)
+        assert model_trained.apply(point.reshape(1, -1).astype(np.float32))[0] != leaf_node
+
+
+@pytest.mark.parametrize('norm_type', ['one_norm', 'infty_norm'])
+def test_leafMatchesMACE(irisTree, norm_type, tmp_path):
+  dataset_obj, model_trained, factual_samples = irisTree
+  epsilon = 1e-3
+  leaf_explanations = generateLeafExplanations.genExpForSamples(
+    [str(tmp_path / 'leaf.txt')] * len(factual_samples),
+    model_trained,
+    dataset_obj,
+    [dict(factual_sample) for factual_sample in factual_samples],
+    norm_type)
+  for factual_sample, leaf_explanation in zip(factual_samples, leaf_explanations):
+    mace_explanation = generateSATExplanations.genExp(
+      str(tmp_path / 'mace.txt'),
+      model_trained,
+      dataset_obj,
+      dict(factual_sample),
+      norm_type,
+      'mace',
+      epsilon)
+    # LEAF is exact; MACE brackets the optimum within epsilon
+    assert mace_explanation['search_lower_bound'] - 1e-9 <= leaf_explanation['cfe_distance']
+    assert leaf_explanation['cfe_distance'] <= mace_explanation['cfe_distance'] + 1e-9
+    assert mace_explanation['cfe_distance'] - leaf_explanation['cfe_distance'] <= epsilon
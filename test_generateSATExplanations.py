@@ -0,0 +1,62 @@
+import itertools
+import warnings
+
+import pytest
+
+import loadData
+import loadModel
+import normalizedDistance
+import generateSATExplanations
+
+warnings.filterwarnings('ignore')
+
+
+def getFactualSamples(dataset_obj, model_trained, num_samples):
+  X_train, X_test, y_train, y_test = dataset_obj.getTrainTestSplit()
+  X_test = X_test.copy()
+  X_test['y'] = model_trained.predict(X_test)
+  factual_samples = X_test.where(X_test['y'] == 0).dropna()[:num_samples]
+  factual_samples = list(factual_samples.T.to_dict().values())
+  for factual_sample in factual_samples:
+    factual_sample['y'] = int(factual_sample['y'])
+  return factual_samples
+
+
+@pytest.fixture(scope = 'module')
+def compassLR():
+  dataset_obj = loadData.loadDataset('compass', return_one_hot = True, load_from_cache = False, debug_flag = False)
+  model_trained = loadModel.loadModelForDataset('lr', 'compass')
+  return dataset_obj, model_trained
+
+
+@pytest.mark.parametrize('norm_type', ['one_norm', 'infty_norm', 'zero_norm'])
+def test_diverseCounterfactualsAreSeparated(compassLR, norm_type, tmp_path):
+  dataset_obj, model_trained = compassLR
+  diversity_distance = 0.02
+  for factual_sample in getFactualSamples(dataset_obj, model_trained, 2):
+    explanation = generateSATExplanations.genExp(
+      str(tmp_path / 'log.txt'),
+      model_trained,
+      dataset_obj,
+      dict(factual_sample),
+      norm_type,
+      'mace',
+      1e-3,
+      num_counterfactuals = 3,
+      diversity_distance = diversity_distance)
+    top_k = explanation['cfe_top_k']
+    assert len(top_k) == 3
+    for cfe_a, cfe_b in itertools.combinations(top_k, 2):
+      pairwise_distance = normalizedDistance.getDistanceBetweenSamples(
+        cfe_a['cfe_sample'], cfe_b['cfe_sample'], norm_type, dataset_obj)
+      assert pairwise_distance >= diversity_distance
+    if norm_type == 'zero_norm':
+      changed_attributes = [
+        frozenset(
+          attr_name_kurz
+          for attr_name_kurz in dataset_obj.getInputAttributeNames('kurz')
+          if cfe['cfe_sample'][attr_name_kurz] != factual_sample[attr_name_kurz]
+        )
+        for cfe in top_k
+      ]
+      assert len(set(changed_attributes)) == len(changed_attributes)
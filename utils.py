@@ -1,6 +1,7 @@
 import inspect
-import collections
+import collections.abc
 import math
+import numpy as np
 
 # See https://www.python-course.eu/python3_memoization.php
 class Memoize:
@@ -28,7 +29,7 @@ class Memoize:
 
     # convert lists and numpy array into tuples so that they can be used as keys
     hashable_args = tuple([
-      arg if isinstance(arg, collections.Hashable) else str(arg)
+      arg if isinstance(arg, collections.abc.Hashable) else str(arg)
       for arg in args
     ])
 
@@ -63,3 +64,47 @@ def round_decimals_down(number: float, decimals: int = 5):
     return math.floor(number)
   factor = 10 ** decimals
   return math.floor(number * factor) / factor
+
+
+def getCanonicalSplitThreshold(threshold, is_integer_based):
+  # IMPORTANT: sklearn goes left iff x <= threshold (as in tree2py), but
+  #            compares the input cast to float32. For integer-based features,
+  #            x <= threshold iff x <= floor(threshold), so that all thresholds
+  #            between two consecutive integers are the same split. For real-
+  #            based features, the canonical threshold is the largest value
+  #            whose float32 goes left: thresholds are often the midpoint of
+  #            two consecutive float32 values, and the midpoint itself (e.g.,
+  #            an unchanged factual value) may be rounded up and go right.
+  #            Shared by the SAT (modelConversion) and LEAF engines, so that
+  #            both agree on every split.
+  if is_integer_based:
+    return int(np.floor(threshold))
+  lower_float32 = np.float32(threshold)
+  if lower_float32 > threshold:
+    lower_float32 = np.nextafter(lower_float32, np.float32(-np.inf))
+  upper_float32 = np.nextafter(lower_float32, np.float32(np.inf))
+  midpoint = (float(lower_float32) + float(upper_float32)) / 2 # exact in float64
+  if np.float32(midpoint) == lower_float32: # ties are rounded to even
+    return midpoint
+  return float(np.nextafter(midpoint, -np.inf))
+
+
+def getMLPPreactivationBounds(model, input_bounds):
+  # IMPORTANT: interval bound propagation: given a (lower, upper) interval for
+  #            each input, returns a (lower, upper) array pair for the
+  #            pre-activations of each layer. A neuron whose pre-activation is
+  #            always positive (negative) is a stable ReLU that acts as the
+  #            identity (zero), and needs no case split in the formula (see
+  #            modelConversion.mlp2formula) or in the MILP (see
+  #            generateMILPExplanations).
+  lower = np.array([bounds[0] for bounds in input_bounds], dtype = float)
+  upper = np.array([bounds[1] for bounds in input_bounds], dtype = float)
+  preactivation_bounds = []
+  for interlayer_idx in range(len(model.coefs_)):
+    positive_weights = np.maximum(model.coefs_[interlayer_idx], 0)
+    negative_weights = np.minimum(model.coefs_[interlayer_idx], 0)
+    pre_lower = lower @ positive_weights + upper @ negative_weights + model.intercepts_[interlayer_idx]
+    pre_upper = upper @ positive_weights + lower @ negative_weights + model.intercepts_[interlayer_idx]
+    preactivation_bounds.append((pre_lower, pre_upper))
+    lower, upper = np.maximum(pre_lower, 0), np.maximum(pre_upper, 0)
+  return preactivation_bounds